@@ -15,8 +15,9 @@ GNU Lesser General Public License for more details.
 You should have received a copy of the Lesser GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-from ansidote.editor import Editor
 
 
-def run_ansicht():
-    Editor().run()
+def run_ansicht(connect=None):
+    # Imported here, so the headless tools don't pull in the editor and Tk
+    from ansidote.editor import Editor
+    Editor(connect).run()
@@ -15,6 +15,7 @@ GNU Lesser General Public License for more details.
 You should have received a copy of the Lesser GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-from ansidote import run_ansicht
+from ansidote.cli import main
 
-run_ansicht()
+if __name__ == "__main__":
+    main()
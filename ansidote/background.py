@@ -0,0 +1,140 @@
+"""
+ansi.e -  A simple ANSI art editor.
+Copyright (C) 2024 Dominik Behrens
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the Lesser GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import queue
+import threading
+import pygame
+import numpy as np
+
+
+class TileRenderer:
+    def __init__(self, event_type):
+        # Posted to the pygame event queue whenever a batch of tiles is ready to be collected
+        self.event_type = event_type
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.generation = 0
+        self.job = None
+        self.done = None
+        threading.Thread(target=self.work, daemon=True).start()
+
+    def request(self, image, px, tiles):
+        # Glyphs are rasterized up front, the worker must not use the font while the main thread does. It gets
+        # the masks and planes as they are now, the atlas may drop the level and the image swap its planes
+        py = image.cell_size(px)[1]
+        chars = set()
+        for tx, ty in tiles:
+            x0, y0, x1, y1 = image.tile_bounds(tx, ty, px)
+            chars.update(np.unique(image.ch[y0:y1, x0:x1]).tolist())
+        masks = image.atlas.masks([chr(c) for c in chars if c > 32], (px, py))
+        planes = image.fg, image.bg, image.ch
+        with self.lock:
+            # A newer request supersedes whatever is still being rendered
+            self.generation += 1
+            self.job = (self.generation, image, px, list(tiles), planes, masks)
+            if image.damage is None:
+                image.damage = []
+        self.wake.set()
+
+    def cancel(self, image=None):
+        with self.lock:
+            self.generation += 1
+            self.job = None
+            self.done = None
+        if image is not None:
+            image.damage = None
+
+    def work(self):
+        while True:
+            self.wake.wait()
+            with self.lock:
+                job, self.job = self.job, None
+                self.wake.clear()
+            if job is None:
+                continue
+            generation, image, px, tiles, planes, masks = job
+            rendered, error = dict(), None
+            try:
+                for tx, ty in tiles:
+                    if generation != self.generation:
+                        break
+                    rendered[(px, tx, ty)] = image.render_tile(tx, ty, px, planes, masks)
+            except Exception as e:
+                # Reported with what was rendered so far, the main thread draws the rest itself
+                error = e
+            finally:
+                with self.lock:
+                    if generation == self.generation:
+                        self.done = (generation, image, rendered)
+                pygame.event.post(pygame.event.Event(self.event_type, generation=generation, error=error))
+
+    def collect(self, image):
+        # Called on the main thread, moves finished tiles into the cache of image
+        with self.lock:
+            done, self.done = self.done, None
+            if done is None or done[0] != self.generation or done[1] is not image:
+                return False
+        for key, srf in done[2].items():
+            image.tiles.put(key, srf)
+        # Cells painted while the tiles were rendered are drawn onto them again
+        damage, image.damage = image.damage or [], None
+        for box in damage:
+            image.invalidate_cells(*box)
+        return True
+
+
+class FileWorker:
+    def __init__(self, event_type, font):
+        # Loads and saves files one after the other, posting event_type with the outcome of each
+        self.event_type = event_type
+        # Its own font for the images it loads, the main thread swaps in the editor's before using them
+        self.font = font
+        self.jobs = queue.Queue()
+        self.pending = 0
+        self.label = None
+        self.progress = 0.0
+        threading.Thread(target=self.work, daemon=True).start()
+
+    def run(self, label, job, fn, *args, **kwargs):
+        # job is handed back as the attributes of the event, together with result and error
+        self.pending += 1
+        self.jobs.put((label, job, fn, args, kwargs))
+
+    def report(self, progress):
+        self.progress = progress
+
+    @property
+    def busy(self):
+        return self.pending > 0
+
+    def work(self):
+        while True:
+            label, job, fn, args, kwargs = self.jobs.get()
+            self.label, self.progress = label, 0.0
+            result, error = None, None
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                # Whatever went wrong is reported, the worker carries on with the next job
+                error = e
+            finally:
+                self.label = None
+                pygame.event.post(pygame.event.Event(self.event_type, result=result, error=error, **job))
+
+    def done(self):
+        # Called on the main thread for every event of this worker
+        self.pending -= 1
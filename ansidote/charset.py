@@ -0,0 +1,76 @@
+"""
+ansi.e -  A simple ANSI art editor.
+Copyright (C) 2024 Dominik Behrens
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the Lesser GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import re
+import unicodedata
+
+from bisect import bisect_left
+
+# Blocks of the character map, in the order they are shown
+BLOCKS = [
+    ("Basic Latin", 0x20, 0x7E),
+    ("Latin-1 Supplement", 0xA0, 0xFF),
+    ("Arrows", 0x2190, 0x21FF),
+    ("Box Drawing", 0x2500, 0x257F),
+    ("Block Elements", 0x2580, 0x259F),
+    ("Geometric Shapes", 0x25A0, 0x25FF),
+    ("Miscellaneous Symbols", 0x2600, 0x26FF),
+    ("Braille Patterns", 0x2800, 0x28FF),
+    ("Symbols for Legacy Computing", 0x1FB00, 0x1FBFF),
+    ("CJK Unified Ideographs", 0x4E00, 0x9FFF),
+]
+
+_WORDS = re.compile(r"[^\s-]+")
+
+
+def load_blocks(blocks=BLOCKS):
+    # Assigned, printable characters of every block as (block name, characters)
+    loaded = []
+    for name, first, last in blocks:
+        chars = "".join(c for c in map(chr, range(first, last + 1))
+                        if c == " " or unicodedata.category(c)[0] not in "CZ")
+        loaded.append((name, chars))
+    return loaded
+
+
+class CharacterIndex:
+    def __init__(self, blocks):
+        # Every word of a name or block lists the positions of its characters, words are kept sorted for prefixes
+        postings = dict()
+        pos = 0
+        for block, chars in blocks:
+            block_words = _WORDS.findall(block.lower())
+            for c in chars:
+                words = _WORDS.findall(unicodedata.name(c, "").lower())
+                words += block_words + [f"u+{ord(c):04x}"]
+                for word in set(words):
+                    postings.setdefault(word, []).append(pos)
+                pos += 1
+        self.words = sorted(postings)
+        self.postings = [postings[word] for word in self.words]
+
+    def search(self, query):
+        # Positions of the characters matching every term of query, terms match the start of words
+        result = None
+        for term in _WORDS.findall(query.lower()):
+            hits = set()
+            i = bisect_left(self.words, term)
+            while i < len(self.words) and self.words[i].startswith(term):
+                hits.update(self.postings[i])
+                i += 1
+            result = hits if result is None else result & hits
+        return sorted(result) if result is not None else []
@@ -0,0 +1,193 @@
+"""
+ansi.e -  A simple ANSI art editor.
+Copyright (C) 2024 Dominik Behrens
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the Lesser GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import argparse
+import glob
+import itertools
+import os
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+# Set up once per worker process
+_font = None
+
+
+def _init_worker(font_size):
+    global _font
+    # No windows and no Tk in the workers, rendering only needs plain surfaces
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    from ansidote.fonts import load_font
+    _font = load_font(font_size)
+
+
+def _open(path, font):
+    from ansidote.image import load_image_from_file
+    from ansidote.native import NATIVE_EXTENSION, load_native
+    return load_native(path, font) if path.lower().endswith(NATIVE_EXTENSION) else load_image_from_file(path, font)
+
+
+def _convert(path, to, out_dir, minimal, columns, colors, dither):
+    import pygame
+    from ansidote.native import save_native
+    from ansidote.raster import RASTER_EXTENSIONS, load_image_from_raster
+
+    start = time.perf_counter()
+    try:
+        base = os.path.splitext(os.path.basename(path))[0]
+        target = os.path.join(out_dir or os.path.dirname(path), f"{base}.{to}")
+        if os.path.abspath(target) == os.path.abspath(path):
+            raise IOError("Would overwrite the input file")
+        if path.lower().endswith(RASTER_EXTENSIONS):
+            # Already running in a pool, so no pool of its own
+            image = load_image_from_raster(path, _font, columns, jobs=1)
+        else:
+            image = _open(path, _font)
+        if to == "png":
+            pygame.image.save(image.render(), target)
+        elif to == "ansb":
+            save_native(image, target)
+        else:
+            image.save_to_file(target, minimal=minimal, palette=colors, dither=dither)
+        return path, target, time.perf_counter() - start, None
+    except Exception as e:
+        # Reported per file, one broken input doesn't stop the others
+        return path, None, time.perf_counter() - start, e
+
+
+def convert(args):
+    paths = []
+    for pattern in args.files:
+        # Shells on some platforms don't expand wildcards for us
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        paths.extend(matches)
+    if args.out is not None:
+        os.makedirs(args.out, exist_ok=True)
+
+    failed = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(args.jobs, initializer=_init_worker, initargs=(args.font_size,)) as pool:
+        futures = [pool.submit(_convert, path, args.to, args.out, args.minimal, args.columns, args.colors, args.dither)
+                   for path in paths]
+        for future in as_completed(futures):
+            path, target, seconds, error = future.result()
+            if error is None:
+                print(f"'{path}' -> '{target}' ({seconds:.3f}s)")
+            else:
+                failed += 1
+                print(f"Could not convert '{path}': {error} ({seconds:.3f}s)", file=sys.stderr)
+    print(f"Converted {len(paths) - failed} of {len(paths)} files in {time.perf_counter() - start:.2f}s")
+    return 1 if failed else 0
+
+
+def play(args):
+    # Plain text output, no window needed
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    from ansidote.fonts import load_font
+
+    try:
+        image = _open(args.file, load_font(16))
+    except (IOError, UnicodeDecodeError) as e:
+        print(f"Could not load from file '{args.file}': {e}", file=sys.stderr)
+        return 1
+    chunks = [chunk.encode("utf-8") for chunk in image.encode_frames(loop=args.loop, palette=args.colors,
+                                                                     dither=args.dither)]
+    out = sys.stdout.buffer
+    # Hide the cursor and start on an empty screen, every later frame only carries the cells that changed
+    out.write(b"\x1b[?25l\x1b[2J\x1b[H" + chunks[0])
+    out.flush()
+    deadline = time.perf_counter()
+    try:
+        for chunk in itertools.cycle(chunks[1:]) if args.loop else chunks[1:]:
+            deadline += 1 / args.fps
+            time.sleep(max(0.0, deadline - time.perf_counter()))
+            out.write(chunk)
+            out.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        out.write(b"\x1b[0m\x1b[?25h\n")
+        out.flush()
+    return 0
+
+
+def serve(args):
+    import asyncio
+    from ansidote.collab import Server
+
+    if args.file is not None:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        from ansidote.fonts import load_font
+        try:
+            image = _open(args.file, load_font(16))
+        except (IOError, UnicodeDecodeError) as e:
+            print(f"Could not load from file '{args.file}': {e}", file=sys.stderr)
+            return 1
+        server = Server(image.w, image.h, image.fg, image.bg, image.ch)
+    else:
+        w, h = map(int, args.size.lower().split("x"))
+        server = Server(w, h)
+    print(f"Serving a {server.w}x{server.h} canvas on '{args.listen}'")
+    try:
+        asyncio.run(server.serve(args.listen))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="ansidote", description="A simple ANSI art editor.")
+    parser.add_argument("--connect", default=None, metavar="ADDRESS",
+                        help="edit together with others on a collaboration server, host:port or unix:/path")
+    commands = parser.add_subparsers(dest="command")
+
+    p = commands.add_parser("convert", help="convert ANSI files and pictures without opening the editor")
+    p.add_argument("files", nargs="+", help="input files, wildcards are allowed")
+    p.add_argument("--to", choices=["png", "ans", "ansb"], default="png", help="output format")
+    p.add_argument("--out", default=None, help="output directory, next to the input by default")
+    p.add_argument("--jobs", "-j", type=int, default=os.cpu_count(), help="number of worker processes")
+    p.add_argument("--font-size", type=int, default=16, help="font size used for rendering")
+    p.add_argument("--minimal", action="store_true", help="write minimal ANSI output")
+    p.add_argument("--columns", type=int, default=None, help="width in cells when converting pictures")
+    p.add_argument("--colors", choices=["256", "16"], default=None, help="palette for ANSI output, 24 bit otherwise")
+    p.add_argument("--dither", action="store_true", help="ordered dithering for palette colors")
+
+    p = commands.add_parser("play", help="play an animated ANSI file in the terminal")
+    p.add_argument("file", help="ANSI file, frames start with a cursor home escape")
+    p.add_argument("--fps", type=float, default=10, help="frames per second")
+    p.add_argument("--loop", action="store_true", help="start over after the last frame until interrupted")
+    p.add_argument("--colors", choices=["256", "16"], default=None, help="for terminals without 24 bit colors")
+    p.add_argument("--dither", action="store_true", help="ordered dithering for palette colors")
+
+    p = commands.add_parser("serve", help="share a canvas with editors started with --connect")
+    p.add_argument("file", nargs="?", default=None, help="ANSI file to start from, an empty canvas otherwise")
+    p.add_argument("--listen", default="127.0.0.1:7007", help="host:port or unix:/path to listen on")
+    p.add_argument("--size", default="120x40", help="size of the empty canvas in cells")
+
+    args = parser.parse_args(argv)
+    if args.command == "convert":
+        sys.exit(convert(args))
+    elif args.command == "play":
+        sys.exit(play(args))
+    elif args.command == "serve":
+        sys.exit(serve(args))
+    else:
+        from ansidote import run_ansicht
+        run_ansicht(args.connect)
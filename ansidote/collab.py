@@ -0,0 +1,207 @@
+"""
+ansi.e -  A simple ANSI art editor.
+Copyright (C) 2024 Dominik Behrens
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the Lesser GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import asyncio
+import struct
+import threading
+import pygame
+import numpy as np
+
+# Every message is a type byte and the payload length, then the payload
+HEADER = struct.Struct("<BI")
+HELLO, DELTA = 1, 2
+# Canvas size, sent by the server before anything else
+SIZE = struct.Struct("<II")
+# One cell on the wire: rgb foreground, rgb background and the code point
+CELL = np.dtype([("fg", "u1", 3), ("bg", "u1", 3), ("ch", "<u4")])
+MAX_PAYLOAD = 256 * 1024 * 1024
+
+
+def message(kind, payload):
+    return HEADER.pack(kind, len(payload)) + payload
+
+
+async def read_message(reader, limit=MAX_PAYLOAD):
+    kind, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if length > limit:
+        raise ValueError(f"Message of {length} bytes is too large")
+    return kind, await reader.readexactly(length)
+
+
+def encode_delta(index, fg, bg, ch):
+    # Flat cell indices as (start, length) ranges of consecutive cells, followed by the cells in the same order
+    index = np.asarray(index, dtype="i8")
+    starts = np.flatnonzero(np.diff(index, prepend=-2) != 1)
+    lengths = np.diff(np.append(starts, len(index)))
+    ranges = np.stack([index[starts], lengths], axis=1).astype("<u4")
+    cells = np.empty(len(index), dtype=CELL)
+    cells["fg"], cells["bg"], cells["ch"] = fg, bg, ch
+    return struct.pack("<I", len(ranges)) + ranges.tobytes() + cells.tobytes()
+
+
+def decode_delta(payload, size):
+    # Anything that doesn't fit a canvas of size cells raises ValueError, before it gets near one
+    if len(payload) < 4:
+        raise ValueError("Delta is cut short")
+    (count,) = struct.unpack_from("<I", payload)
+    if len(payload) < 4 + 8 * count:
+        raise ValueError("Delta is cut short")
+    ranges = np.frombuffer(payload, dtype="<u4", count=2 * count, offset=4).reshape(-1, 2)
+    starts, lengths = ranges[:, 0].astype("i8"), ranges[:, 1].astype("i8")
+    if len(payload) - 4 - ranges.nbytes != lengths.sum() * CELL.itemsize:
+        raise ValueError("Delta cells don't match its ranges")
+    if (starts + lengths > size).any():
+        raise ValueError("Delta is outside of the canvas")
+    cells = np.frombuffer(payload, dtype=CELL, offset=4 + ranges.nbytes)
+    if (cells["ch"] > 0x10FFFF).any():
+        raise ValueError("Delta has invalid characters")
+    # Back to one index per cell: each range counts up from its start
+    index = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    return index, cells
+
+
+def parse_address(address):
+    # "unix:/path/to/socket" or "host:port"
+    if address.startswith("unix:"):
+        return None, address[5:]
+    host, _, port = address.rpartition(":")
+    return (host or "127.0.0.1", int(port)), None
+
+
+async def open_connection(address):
+    tcp, path = parse_address(address)
+    if path is not None:
+        return await asyncio.open_unix_connection(path)
+    return await asyncio.open_connection(*tcp)
+
+
+class Server:
+    def __init__(self, w, h, fg=None, bg=None, ch=None):
+        # The shared canvas as flat planes, new clients get all of it, everything else is passed on as deltas
+        self.w, self.h = w, h
+        self.fg = np.zeros((w * h, 3), dtype="u1") if fg is None else fg.reshape(-1, 3).copy()
+        self.bg = np.zeros((w * h, 3), dtype="u1") if bg is None else bg.reshape(-1, 3).copy()
+        self.ch = np.full(w * h, 32, dtype="u4") if ch is None else ch.reshape(-1).copy()
+        self.clients = set()
+        self.deltas = 0
+        # No client needs more than one range and one cell per cell of the canvas
+        self.limit = 4 + (8 + CELL.itemsize) * w * h
+
+    def apply(self, payload):
+        # A client sending a broken delta is dropped
+        index, cells = decode_delta(payload, self.w * self.h)
+        self.fg[index], self.bg[index], self.ch[index] = cells["fg"], cells["bg"], cells["ch"]
+
+    async def handle(self, reader, writer):
+        writer.write(message(HELLO, SIZE.pack(self.w, self.h)))
+        writer.write(message(DELTA, encode_delta(np.arange(self.w * self.h), self.fg, self.bg, self.ch)))
+        self.clients.add(writer)
+        try:
+            await writer.drain()
+            while True:
+                kind, payload = await read_message(reader, self.limit)
+                if kind != DELTA:
+                    continue
+                self.apply(payload)
+                self.deltas += 1
+                # Passed on as received, nobody has to encode it again. The sender gets it back as well: clients
+                # apply every delta in the order the server did, so cells written at the same time end up the same
+                data = message(DELTA, payload)
+                for other in self.clients:
+                    other.write(data)
+                await asyncio.gather(*(other.drain() for other in self.clients), return_exceptions=True)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    async def start(self, address):
+        tcp, path = parse_address(address)
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle, path)
+        return await asyncio.start_server(self.handle, *tcp)
+
+    async def serve(self, address):
+        server = await self.start(address)
+        async with server:
+            await server.serve_forever()
+
+
+class Client:
+    def __init__(self, address, event_type):
+        # Runs its own event loop in a thread, posts event_type to pygame whenever deltas came in
+        self.address = address
+        self.event_type = event_type
+        self.lock = threading.Lock()
+        self.incoming = list()
+        self.size = None
+        self.error = None
+        self.connected = threading.Event()
+        self.loop = asyncio.new_event_loop()
+        self.writer = None
+        threading.Thread(target=self.loop.run_until_complete, args=(self.run(),), daemon=True).start()
+
+    async def run(self):
+        try:
+            reader, self.writer = await open_connection(self.address)
+            kind, hello = await read_message(reader)
+            if kind != HELLO:
+                raise ValueError("Server did not say hello")
+            w, h = SIZE.unpack(hello)
+            # The whole canvas comes next, it is waiting in incoming by the time connected is set.
+            # Deltas are checked as they come in, a server sending broken ones is left
+            kind, payload = await read_message(reader)
+            self.incoming.append(decode_delta(payload, w * h))
+            self.size = w, h
+            self.connected.set()
+            while True:
+                kind, payload = await read_message(reader)
+                if kind == DELTA:
+                    delta = decode_delta(payload, w * h)
+                    with self.lock:
+                        self.incoming.append(delta)
+                        first = len(self.incoming) == 1
+                    if first:
+                        pygame.event.post(pygame.event.Event(self.event_type))
+        except (OSError, asyncio.IncompleteReadError, ValueError, struct.error) as e:
+            self.error = e
+            if self.connected.is_set():
+                # Lost on the way, the editor hears about it with the next collect
+                pygame.event.post(pygame.event.Event(self.event_type))
+            self.connected.set()
+
+    def send(self, image, index):
+        # The visible cells at index as one delta, called for every write to the shared image
+        index = np.asarray(index, dtype="i8")
+        if self.writer is None or self.error is not None or len(index) == 0:
+            return
+        payload = encode_delta(index, image.fg.reshape(-1, 3)[index], image.bg.reshape(-1, 3)[index],
+                               image.ch.reshape(-1)[index])
+        self.loop.call_soon_threadsafe(self.writer.write, message(DELTA, payload))
+
+    def collect(self, image):
+        # Called on the main thread, writes what the others drew into image without sending it back
+        with self.lock:
+            incoming, self.incoming = self.incoming, list()
+        sync, image.sync = image.sync, None
+        try:
+            for index, cells in incoming:
+                image.write_cells(index, cells["fg"], cells["bg"], cells["ch"], record=False)
+        finally:
+            image.sync = sync
+        return len(incoming)
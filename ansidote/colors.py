@@ -0,0 +1,83 @@
+"""
+ansi.e -  A simple ANSI art editor.
+Copyright (C) 2024 Dominik Behrens
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the Lesser GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import functools
+import numpy as np
+
+# The 16 basic colors as the VGA text mode shows them, which is what most ANSI art is drawn for
+VGA_16 = np.array([
+    (0, 0, 0), (170, 0, 0), (0, 170, 0), (170, 85, 0),
+    (0, 0, 170), (170, 0, 170), (0, 170, 170), (170, 170, 170),
+    (85, 85, 85), (255, 85, 85), (85, 255, 85), (255, 255, 85),
+    (85, 85, 255), (255, 85, 255), (85, 255, 255), (255, 255, 255)
+], dtype="u1")
+
+
+def _xterm_256():
+    levels = np.array([0, 95, 135, 175, 215, 255], dtype="u1")
+    r, g, b = np.meshgrid(levels, levels, levels, indexing="ij")
+    cube = np.stack((r.ravel(), g.ravel(), b.ravel()), axis=-1)
+    gray = np.repeat(np.arange(8, 248, 10, dtype="u1")[:, None], 3, axis=1)
+    return np.concatenate((VGA_16, cube, gray))
+
+
+XTERM_256 = _xterm_256()
+
+# What a terminal shows after a reset
+DEFAULT_FG = (170, 170, 170)
+DEFAULT_BG = (0, 0, 0)
+
+# Palettes for quantized export, by name: colors, index of the first one and the distance between neighbours.
+# The first 16 xterm colors follow the theme of the terminal, so 256 color output sticks to the cube and grays
+PALETTES = {"256": (XTERM_256[16:], 16, 40), "16": (VGA_16, 0, 85)}
+
+# Ordered dithering thresholds, centered around zero
+_BAYER = (np.array([[0, 8, 2, 10], [12, 4, 14, 6], [3, 11, 1, 9], [15, 7, 13, 5]]) + 0.5) / 16 - 0.5
+
+
+@functools.lru_cache(maxsize=None)
+def palette_lut(name):
+    # Nearest palette index of every color, looked up with 5 bits per channel
+    colors, first, _ = PALETTES[name]
+    centers = np.arange(4, 256, 8, dtype="i4")
+    lut = np.empty((32, 32 * 32), dtype="u1")
+    g, b = np.meshgrid(centers, centers, indexing="ij")
+    for r in range(32):
+        # One red level at a time keeps the distance table small
+        grid = np.stack((np.full(g.size, centers[r]), g.ravel(), b.ravel()), axis=-1)
+        dist = ((grid[:, None, :] - colors[None, :, :].astype("i4")) ** 2).sum(axis=-1)
+        lut[r] = dist.argmin(axis=1) + first
+    return lut.ravel()
+
+
+def quantize(rgb, name, dither=False):
+    # (h, w, 3) colors as indices into palette name, dither breaks up banding in a fixed 4x4 pattern
+    rgb = rgb.astype("i2")
+    if dither:
+        h, w = rgb.shape[:2]
+        offset = np.tile(_BAYER, (h // 4 + 1, w // 4 + 1))[:h, :w] * PALETTES[name][2]
+        rgb = np.clip(rgb + offset.astype("i2")[..., None], 0, 255)
+    index = palette_lut(name)[(rgb[..., 0] >> 3) * 1024 + (rgb[..., 1] >> 3) * 32 + (rgb[..., 2] >> 3)]
+    # Colors of the palette itself stay what they are, whatever bin they share
+    colors, first, _ = PALETTES[name]
+    packed = (rgb[..., 0].astype("i4") << 16) | (rgb[..., 1].astype("i4") << 8) | rgb[..., 2]
+    keys = (colors[:, 0].astype("i4") << 16) | (colors[:, 1].astype("i4") << 8) | colors[:, 2]
+    order = np.argsort(keys)
+    at = np.minimum(np.searchsorted(keys[order], packed), len(keys) - 1)
+    exact = keys[order][at] == packed
+    index[exact] = order[at[exact]] + first
+    return index
@@ -0,0 +1,60 @@
+"""
+ansi.e -  A simple ANSI art editor.
+Copyright (C) 2024 Dominik Behrens
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the Lesser GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import tkinter
+
+from tkinter import Tk, filedialog, colorchooser
+from tkinter.simpledialog import Dialog
+
+# Everything tkinter lives here, the editor only imports it once the first dialog is opened
+__all__ = ["Tk", "filedialog", "colorchooser", "SettingsDialog", "open_settings_dialog"]
+
+
+class SettingsDialog(Dialog):
+    def __init__(self, w, h):
+        self.entry1, self.entry2 = None, None
+        self.w, self.h = w, h
+        super().__init__(None)
+
+    def body(self, master):
+        tkinter.Label(master, text="Canvas Width:").grid(row=0)
+        self.entry1 = tkinter.Entry(master)
+        self.entry1.insert(0, str(self.w))
+        self.entry1.grid(row=0, column=1)
+
+        tkinter.Label(master, text="Canvas Height:").grid(row=1)
+        self.entry2 = tkinter.Entry(master)
+        self.entry2.insert(0, str(self.h))
+        self.entry2.grid(row=1, column=1)
+        return self.entry1
+
+    def apply(self):
+        try:
+            self.w = int(self.entry1.get())
+            self.h = int(self.entry2.get())
+        except ValueError:
+            print("Invalid W/H")
+        super().apply()
+
+    def cancel(self, event: None = ...):
+        self.withdraw()
+        self.destroy()
+
+
+def open_settings_dialog(w, h):
+    d = SettingsDialog(w, h)
+    return d.w, d.h
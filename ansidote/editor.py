@@ -15,19 +15,28 @@ GNU Lesser General Public License for more details.
 You should have received a copy of the Lesser GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-import os.path
+import os
 import sys
+import math
+import time
 import pygame
 
+from ansidote.background import FileWorker, TileRenderer
+from ansidote.collab import Client
+from ansidote.fonts import cache_dir, find_font
+from ansidote.history import Journal
 from ansidote.image import Image, load_image_from_file
-from ansidote.ui import CharacterMap, open_settings_dialog, HistoryPalette
-from tkinter import Tk, filedialog, colorchooser
+from ansidote.native import NATIVE_EXTENSION, load_native, remap_native, snapshot_native, write_native
+from ansidote.profiler import FrameProfiler
+from ansidote.raster import RASTER_EXTENSIONS, load_image_from_raster
+from ansidote.tools import Stroke, copy_rect, cut_rect, flood_fill, move_rect, paste, rect_fill
+from ansidote.ui import CharacterMap, HistoryPalette
 
-from ansidote.resources import icon_open, icon_save, icon_settings
+from ansidote import resources
 
 
 class Editor:
-    def __init__(self):
+    def __init__(self, connect=None):
         pygame.init()
 
         # Initial window size
@@ -45,42 +54,119 @@ class Editor:
         self.clock = pygame.time.Clock()
 
         # Font
-        # Try some of these before giving up
         self.font_size = 16
-        self.font_name = pygame.font.get_default_font()
-        monospace_fonts = ["Hack", "Source Code Pro", "Consolas", "Lucida Console", "Courier New", "Monospace"]
-        for font in monospace_fonts:
-            path = pygame.font.match_font(font)
-            if path is not None and os.path.exists(path):
-                self.font_name = path
-                break
+        self.font_name = find_font()
         self.font = pygame.font.Font(self.font_name, self.font_size)
 
-        # Hidden TKInter Root node for file and color dialogs
-        self.tk_root = Tk()
-        self.tk_root.withdraw()
+        # Hidden TKInter Root node for file and color dialogs, created when the first one opens
+        self.tk_root = None
 
         # Icon Square sizes
         self.w_icons = 48
 
         # Palette remembers last 12 used colors
         self.palette = HistoryPalette(320 * 0.9, 2 * self.w_icons)
+        self.sidebar = None
+        self.sidebar_key = None
 
-        # Default image
+        # Default image, with undo
+        self.journal = Journal()
         self.image = Image(120, 40, self.font)
+        self.image.journal = self.journal
+        self.stroke = Stroke()
         self.cursor = None
+        # Status bar thumbnail of the active layer, scaled again when the layer changes
+        self.layer_thumb = (None, None)
+
+        # Brush, eraser, flood fill, rectangle or selection, rectangles are spanned from the anchor cell
+        self.tool = "brush"
+        self.fill_tolerance = 0
+        self.anchor = None
+        # Selected block as (x0, y0, x1, y1), the cell it is dragged by while moving it, and the last copied
+        # block as (fg, bg, ch, mask) planes
+        self.selection = None
+        self.grab = None
+        self.clipboard = None
         self.mx, self.my = (self.screen.get_width() - 320) / 2, (self.screen.get_height() - 32) / 2
 
         self.draw_fg_color = 255, 255, 255
         self.draw_bg_color = 0, 0, 0
 
-        # Default Character Map
-        self.char_map = CharacterMap(320 * .9, self.font)
+        # Character map fills the rest of the sidebar, Ctrl+F filters it, the query is None when not typing one
+        self.char_map = CharacterMap(320 * .9, self.font, self.char_map_height())
+        self.search = None
+
+        # Screen areas that changed since the last frame
+        self.dirty = []
+
+        # Zoom levels are rendered in the background, meanwhile a scaled snapshot of the canvas is shown
+        self.tiles_ready = pygame.event.custom_type()
+        self.renderer = TileRenderer(self.tiles_ready)
+        self.preview = None
+        # Set while a fresh canvas renders in the background, until then only cached tiles are drawn
+        self.loading = False
+
+        # Frame timing, F3 shows it in the status bar, F4 records a trace
+        self.profiler = FrameProfiler()
+        self.overlay_tick = pygame.event.custom_type()
+
+        # Files are read and written in the background, the status bar shows how far along that is
+        self.file_done = pygame.event.custom_type()
+        self.files = FileWorker(self.file_done, pygame.font.Font(self.font_name, self.font_size))
+        self.file_tick = pygame.event.custom_type()
+        # Every minute the canvas goes to the cache directory, after the first time only the rows changed since
+        self.autosave_tick = pygame.event.custom_type()
+        self.autosaved = None
+        pygame.time.set_timer(self.autosave_tick, 60000)
+
+        # Shared canvas, when connected to a collaboration server
+        self.collab = None
+        self.collab_event = pygame.event.custom_type()
+        if connect is not None:
+            self.connect(connect)
+
+    def dialogs(self):
+        from ansidote import dialogs
+        if self.tk_root is None:
+            self.tk_root = dialogs.Tk()
+            self.tk_root.withdraw()
+        return dialogs
+
+    def request_tiles(self):
+        # Hands the visible tiles that are not cached yet to the renderer, False if there are none
+        tiles = [(tx, ty) for tx, ty, _, _ in self.image.visible_tiles(self.image_origin(), self.layout()[0])
+                 if (self.image.px, tx, ty) not in self.image.tiles.tiles]
+        if tiles:
+            self.renderer.request(self.image, self.image.px, tiles)
+        return bool(tiles)
 
     def zoom(self, event):
         neg = event.precise_y < 0
         factor = 0.5 if neg else 1.5
+        old = self.image.px
         self.image.resize(factor)
+        if self.image.px == old:
+            return
+        canvas = self.layout()[0]
+        if self.preview is None and not self.loading:
+            self.preview = (self.screen.subsurface(canvas).copy(), old, self.mx - canvas.x, self.my - canvas.y)
+        if not self.request_tiles():
+            # Everything visible is still cached from an earlier visit of this zoom level
+            self.renderer.cancel(self.image)
+            self.preview = None
+            self.loading = False
+        self.invalidate(canvas)
+
+    def draw_preview(self, canvas):
+        # The snapshot scaled around the canvas center, only the part that ends up on screen
+        base, base_px, ax, ay = self.preview
+        f = self.image.px / base_px
+        left, top = self.mx - ax * f, self.my - ay * f
+        src = pygame.Rect(int((canvas.x - left) / f), int((canvas.y - top) / f),
+                          math.ceil(canvas.w / f) + 1, math.ceil(canvas.h / f) + 1).clip(base.get_rect())
+        if src.width > 0 and src.height > 0:
+            srf = pygame.transform.scale(base.subsurface(src), (round(src.width * f), round(src.height * f)))
+            self.screen.blit(srf, (left + src.x * f, top + src.y * f))
 
     def brush_preview(self):
         txt = self.font.render(self.char_map.selected, 1, self.draw_fg_color)
@@ -90,37 +176,52 @@ class Editor:
         return srf
 
     def draw_sidebar(self, x, width, height):
+        # Composed once and blitted as a whole until colors, glyph, palette or character map change
+        key = (width, height, self.draw_fg_color, self.draw_bg_color, self.char_map.selected,
+               self.char_map.version, self.palette.version)
+        if key != self.sidebar_key:
+            with self.profiler.span("compose_sidebar"):
+                self.compose_sidebar(width, height)
+            self.sidebar_key = key
+        self.screen.blit(self.sidebar, (x, 0))
+
+    def compose_sidebar(self, width, height):
         def w(frac):
             return int(width * frac)
 
+        if self.sidebar is None or self.sidebar.get_size() != (width, height):
+            self.sidebar = pygame.Surface((width, height))
+        srf = self.sidebar
+
         # Basic Background Fill
-        self.screen.fill((60, 65, 70), (x, 0, width, height))
+        srf.fill((60, 65, 70))
 
         # Open, Save, Options, etc.
         offset = (w(.8) - 3 * self.w_icons) / 2
-        self.screen.blit(icon_open, (x + offset + w(.05) + 8, w(.05) + 8))
-        self.screen.blit(icon_save, (x + offset + w(.1) + self.w_icons + 8, w(.05) + 8))
-        self.screen.blit(icon_settings, (x + offset + w(.15) + 2 * self.w_icons + 8, w(.05) + 8))
+        srf.blit(resources.icon_open, (offset + w(.05) + 8, w(.05) + 8))
+        srf.blit(resources.icon_save, (offset + w(.1) + self.w_icons + 8, w(.05) + 8))
+        srf.blit(resources.icon_settings, (offset + w(.15) + 2 * self.w_icons + 8, w(.05) + 8))
 
         # FG/BG Selectors
         offset = (w(.9) - 1.5 * self.w_icons) / 2
-        self.screen.fill(self.draw_bg_color, (x + offset + w(.05) + 0.5 * self.w_icons, w(.1) + 1.5 * self.w_icons,
-                                              self.w_icons, self.w_icons))
-        self.screen.fill(self.draw_fg_color, (x + offset + w(.05), w(.1) + self.w_icons,
-                                              self.w_icons, self.w_icons))
+        srf.fill(self.draw_bg_color, (offset + w(.05) + 0.5 * self.w_icons, w(.1) + 1.5 * self.w_icons,
+                                      self.w_icons, self.w_icons))
+        srf.fill(self.draw_fg_color, (offset + w(.05), w(.1) + self.w_icons,
+                                      self.w_icons, self.w_icons))
         # Brush Preview
-        preview = self.brush_preview()
-        pygame.draw.rect(self.screen, (180, 180, 180), (x + w(.2) + 4 * self.w_icons - 1,
-                                                        w(.1) + 1.25 * self.w_icons - 1,
-                                                        self.w_icons + 2, self.w_icons + 2), width=1)
-        self.screen.blit(preview, (x + w(.2) + 4 * self.w_icons + abs(self.w_icons - preview.get_width()) / 2,
-                                   w(.1) + 1.25 * self.w_icons + abs(self.w_icons - preview.get_height()) / 2))
+        with self.profiler.span("brush_preview"):
+            preview = self.brush_preview()
+        pygame.draw.rect(srf, (180, 180, 180), (w(.2) + 4 * self.w_icons - 1,
+                                                w(.1) + 1.25 * self.w_icons - 1,
+                                                self.w_icons + 2, self.w_icons + 2), width=1)
+        srf.blit(preview, (w(.2) + 4 * self.w_icons + abs(self.w_icons - preview.get_width()) / 2,
+                           w(.1) + 1.25 * self.w_icons + abs(self.w_icons - preview.get_height()) / 2))
 
         # History Palette
-        self.screen.blit(self.palette.surface, (x + w(0.05), w(0.15) + 2.5 * self.w_icons))
+        srf.blit(self.palette.surface, (w(0.05), w(0.15) + 2.5 * self.w_icons))
 
         # Symbol table
-        self.screen.blit(self.char_map.surface, (x + w(.05), w(0.2) + 4.5 * self.w_icons))
+        srf.blit(self.char_map.surface, (w(.05), self.char_map_top()))
 
     def change_color(self, color: tuple, bg=False):
         if bg:
@@ -129,6 +230,7 @@ class Editor:
             self.draw_fg_color = color
         # Remember the picked color
         self.palette.remember(color)
+        self.invalidate(self.layout()[1])
 
     def mouse(self, event):
         if event.button == 1 or event.button == 3:
@@ -140,7 +242,7 @@ class Editor:
             sy = .1 * 320 + self.w_icons
             if sx < x < sx + self.w_icons and sy < y < sy + self.w_icons:
                 init = f"#{self.draw_fg_color[0]:02X}{self.draw_fg_color[1]:02X}{self.draw_fg_color[2]:02X}"
-                tup, hex_str = colorchooser.askcolor(initialcolor=init)
+                tup, hex_str = self.dialogs().colorchooser.askcolor(initialcolor=init)
                 if tup is not None:
                     self.change_color(tuple(map(int, tup)), False)
 
@@ -149,7 +251,7 @@ class Editor:
             sy += 0.5 * self.w_icons
             if sx < x < sx + self.w_icons and sy < y < sy + self.w_icons:
                 init = f"#{self.draw_bg_color[0]:02X}{self.draw_bg_color[1]:02X}{self.draw_bg_color[2]:02X}"
-                tup, hex_str = colorchooser.askcolor(initialcolor=init)
+                tup, hex_str = self.dialogs().colorchooser.askcolor(initialcolor=init)
                 if tup is not None:
                     self.change_color(tuple(map(int, tup)), True)
 
@@ -163,109 +265,547 @@ class Editor:
                     self.change_color(color, event.button == 3)
 
             # Character Map
-            sy = .2 * 320 + 2.5 * self.w_icons + self.palette.h
+            sy = self.char_map_top()
             if sx < x < w - .05 * 320 and sy < y < sy + self.char_map.h:
                 mapped_x, mapped_y = int((x - sx) / self.char_map.sq), int((y - sy) / self.char_map.sq)
                 self.char_map.select(mapped_x, mapped_y)
+                self.invalidate((sx, sy, self.char_map.w, self.char_map.h))
 
             # Open Button
             sx = (w - 320) + .05 * 320 + (.8 * 320 - 3 * self.w_icons) / 2
             sy = .05 * 320
-            if sx < x < sx + self.w_icons and sy < y < sy + self.w_icons:
-                f = filedialog.askopenfilename(filetypes=[("ANSI File", "*.ans")],
-                                               title="Open...")
-                try:
-                    if type(f) is str:
-                        self.image = load_image_from_file(str(f), self.font)
-                        print(f"Opened file '{f}'!")
-                    else:
-                        raise IOError
-                except IOError:
+            if sx < x < sx + self.w_icons and sy < y < sy + self.w_icons and self.collab is not None:
+                print("A shared canvas can't be replaced by another file")
+            elif sx < x < sx + self.w_icons and sy < y < sy + self.w_icons:
+                images = " ".join(f"*{e}" for e in RASTER_EXTENSIONS)
+                f = self.dialogs().filedialog.askopenfilename(filetypes=[("ANSI File", "*.ans"),
+                                                                         ("Canvas", f"*{NATIVE_EXTENSION}"),
+                                                                         ("Image", images)],
+                                                              title="Open...")
+                if type(f) is str and f.lower().endswith(RASTER_EXTENSIONS):
+                    # Pictures are converted to half blocks at the current canvas width
+                    self.run_file(f"Importing '{os.path.basename(f)}'", dict(action="open", path=f),
+                                  load_image_from_raster, f, self.files.font, self.image.w)
+                elif type(f) is str and f.lower().endswith(NATIVE_EXTENSION):
+                    self.run_file(f"Opening '{os.path.basename(f)}'", dict(action="open", path=f),
+                                  load_native, f, self.files.font)
+                elif type(f) is str and f:
+                    self.run_file(f"Opening '{os.path.basename(f)}'", dict(action="open", path=f),
+                                  load_image_from_file, f, self.files.font, progress=self.files.report)
+                else:
                     print(f"Could not load from file '{f}'!")
-                except UnicodeDecodeError:
-                    print(f"Could not decode character. This should not happen :(")
 
             # Save Button
             sx += .05 * 320 + self.w_icons
             if sx < x < sx + self.w_icons and sy < y < sy + self.w_icons:
-                f = filedialog.asksaveasfilename(confirmoverwrite=True,
-                                                 filetypes=[("ANSI File", "*.ans")],
-                                                 title="Save As...",
-                                                 defaultextension=".ans")
-                try:
-                    if type(f) is str:
-                        self.image.save_to_file(f)
-                        print(f"Saved to file '{f}'!")
-                    else:
-                        raise IOError()
-                except IOError:
+                f = self.dialogs().filedialog.asksaveasfilename(confirmoverwrite=True,
+                                                                filetypes=[("ANSI File", "*.ans"),
+                                                                           ("Canvas", f"*{NATIVE_EXTENSION}")],
+                                                                title="Save As...",
+                                                                defaultextension=".ans")
+                # Painting goes on while a copy of the canvas is written
+                job = dict(action="save", path=f, image=self.image)
+                if type(f) is str and f.lower().endswith(NATIVE_EXTENSION):
+                    self.run_file(f"Saving '{os.path.basename(f)}'", job, write_native,
+                                  snapshot_native(self.image, f, self.image.native), progress=self.files.report)
+                elif type(f) is str and f:
+                    self.run_file(f"Saving '{os.path.basename(f)}'", job, self.image.snapshot().save_to_file, f,
+                                  progress=self.files.report)
+                else:
                     print(f"Could not save to file '{f}'!")
-                except UnicodeEncodeError:
-                    print(f"Could not encode character. This should not happen :(")
 
             # Settings Button
             sx += .05 * 320 + self.w_icons
             if sx < x < sx + self.w_icons and sy < y < sy + self.w_icons:
-                new_w, new_h = open_settings_dialog(self.image.w, self.image.h)
-                if new_w != self.image.w or new_h != self.image.h:
-                    self.image = Image(new_w, new_h, self.font)
-
-    def redraw(self):
+                new_w, new_h = self.dialogs().open_settings_dialog(self.image.w, self.image.h)
+                if new_w == self.image.w and new_h == self.image.h:
+                    pass
+                elif self.collab is not None:
+                    print("The size of a shared canvas can't be changed")
+                elif new_w <= 0 or new_h <= 0:
+                    print(f"Invalid canvas size {new_w}x{new_h}")
+                else:
+                    self.resize_canvas(new_w, new_h)
+
+    def run_file(self, label, job, fn, *args, **kwargs):
+        self.files.run(label, job, fn, *args, **kwargs)
+        # Keeps the progress in the status bar moving
+        pygame.time.set_timer(self.file_tick, 100)
+        self.invalidate(self.layout()[2])
+
+    def file_finished(self, event):
+        self.files.done()
+        if not self.files.busy:
+            pygame.time.set_timer(self.file_tick, 0)
+        self.invalidate(self.layout()[2])
+        if event.action == "autosave":
+            if event.error is None and event.image is self.image:
+                self.autosaved = event.result
+        elif event.error is not None:
+            verb = "load from" if event.action == "open" else "save to"
+            print(f"Could not {verb} file '{event.path}': {event.error}")
+        elif event.action == "open" and self.collab is not None:
+            # Connected while it was loading, the shared canvas stays
+            print(f"Not opening '{event.path}' over a shared canvas")
+        elif event.action == "open":
+            # Loaded with the font of the worker, drawn with ours
+            event.result.use_font(self.font)
+            self.set_image(event.result)
+            print(f"Opened file '{event.path}'!")
+        else:
+            if event.path.lower().endswith(NATIVE_EXTENSION) and event.image is self.image:
+                self.image.native = event.result
+                # Not while another save may still replace the file
+                if not self.files.busy:
+                    remap_native(self.image, event.result)
+            print(f"Saved to file '{event.path}'!")
+
+    def autosave(self):
+        # Skipped while other files are busy and when nothing changed since the last time
+        layers = [layer for layers in self.image.frames for layer in layers]
+        state = tuple(layer.uid for layer in layers), tuple(layer.version for layer in layers)
+        if self.files.busy or (self.autosaved is not None and self.autosaved[2:] == state):
+            return
+        path = os.path.join(cache_dir(), "autosave" + NATIVE_EXTENSION)
+        try:
+            os.makedirs(cache_dir(), exist_ok=True)
+        except OSError:
+            return
+        # Only changed rows are copied here, a full write reads the canvas in the background
+        self.run_file("Autosaving", dict(action="autosave", path=path, image=self.image), write_native,
+                      snapshot_native(self.image, path, self.autosaved, copy=False), progress=self.files.report)
+
+    def connect(self, address):
+        client = Client(address, self.collab_event)
+        client.connected.wait(10)
+        if client.size is None:
+            print(f"Could not connect to '{address}': {client.error or 'timed out'}")
+            return
+        print(f"Connected to '{address}'!")
+        self.collab = client
+        self.set_image(Image(*client.size, self.font))
+        client.collect(self.image)
+
+    def set_image(self, image):
+        # A new canvas starts a new history
+        self.journal.clear()
+        self.renderer.cancel(self.image)
+        self.preview = None
+        self.image = image
+        self.image.journal = self.journal
+        self.image.sync = self.collab
+        self.autosaved = None
+        self.selection = None
+        self.loading = self.request_tiles()
+        self.invalidate()
+
+    def resize_canvas(self, w, h):
+        # Same canvas, so unlike set_image the history stays
+        self.renderer.cancel(self.image)
+        self.preview = None
+        self.image.resize_canvas(w, h)
+        self.autosaved = None
+        self.selection = None
+        self.loading = self.request_tiles()
+        self.invalidate()
+
+    def undo(self, redo=False):
+        step = self.journal.redo(self.image) if redo else self.journal.undo(self.image)
+        if step is not None:
+            # Steps that moved the selection take it along
+            if step.selection is not None:
+                self.selection = step.selection[1 if redo else 0]
+            self.invalidate(self.layout()[0])
+
+    def mark_selection(self, last, before):
+        # The step made since last moved the selection from before to where it is now
+        if self.journal.undo_steps and self.journal.undo_steps[-1] is not last:
+            self.journal.undo_steps[-1].selection = before, self.selection
+
+    def char_map_top(self):
+        return .2 * 320 + 2.5 * self.w_icons + self.palette.h
+
+    def char_map_height(self):
+        return self.screen.get_height() - 32 - self.char_map_top() - 8
+
+    def over_char_map(self, pos):
+        w = self.screen.get_width()
+        return w - .95 * 320 < pos[0] < w - .05 * 320 and 0 < pos[1] - self.char_map_top() < self.char_map.h
+
+    def find_char(self, event):
+        # Typing filters the character map by name or block, Return keeps the result, Escape drops it
+        if event.key == pygame.K_RETURN:
+            self.search = None
+        elif event.key == pygame.K_ESCAPE:
+            self.search = None
+            self.char_map.search("")
+        elif event.key == pygame.K_BACKSPACE:
+            self.search = self.search[:-1]
+            self.char_map.search(self.search)
+        elif event.unicode and event.unicode.isprintable():
+            self.search += event.unicode
+            self.char_map.search(self.search)
+        self.invalidate(self.layout()[1])
+        self.invalidate(self.layout()[2])
+
+    def layout(self):
+        # Canvas, sidebar and status bar areas of the window
         w, h = self.screen.get_width(), self.screen.get_height()
+        return pygame.Rect(0, 0, w - 320, h - 32), pygame.Rect(w - 320, 0, 320, h - 32), pygame.Rect(0, h - 32, w, 32)
+
+    def invalidate(self, rect=None):
+        self.dirty.append(self.screen.get_rect() if rect is None else pygame.Rect(rect))
 
-        self.screen.fill((30, 33, 35))
+    def image_origin(self):
+        psx, psy = self.image.px, round(self.image.aspect * self.image.px)
+        return self.mx - self.image.w / 2 * psx, self.my - self.image.h / 2 * psy
+
+    def cell_at(self, pos):
+        psx, psy = self.image.px, round(self.image.aspect * self.image.px)
+        sx, sy = self.image_origin()
+        x, y = pos
+        if sx < x < sx + self.image.w * psx and sy < y < sy + self.image.h * psy and x < self.layout()[0].right:
+            return int((x - sx) / psx), int((y - sy) / psy)
+        return None
+
+    def cell_rect(self, cell):
+        psx, psy = self.image.px, round(self.image.aspect * self.image.px)
+        sx, sy = self.image_origin()
+        return pygame.Rect(sx + cell[0] * psx, sy + cell[1] * psy, psx, psy).inflate(2, 2)
+
+    def move_cursor(self, pos):
+        cell = self.cell_at(pos)
+        if cell != self.cursor:
+            if self.cursor is not None:
+                self.invalidate(self.cell_rect(self.cursor))
+            if cell is not None:
+                self.invalidate(self.cell_rect(cell))
+            self.invalidate(self.layout()[2])
+            self.cursor = cell
+
+    def use_cursor(self, buttons, rel=(0, 0)):
+        if self.cursor is None:
+            self.stroke.lift()
+            return
+        mapped_x, mapped_y = self.cursor
+        # Are we drawing? The cells are written once per frame in paint()
+        if buttons[0]:
+            if self.tool in ("brush", "erase"):
+                self.stroke.move(self.cursor)
+            elif self.anchor is not None or self.grab is not None:
+                self.invalidate(self.layout()[0])
+        elif buttons[2]:
+            # Pick color and symbol from image
+            fg, bg, s = self.image.get_cell(mapped_x, mapped_y)
+            self.change_color(fg, False)
+            self.change_color(bg, True)
+            self.char_map.choose(s)
+        # Are we moving the image around?
+        elif buttons[1]:
+            self.mx += 0.5 * rel[0]
+            self.my += 0.5 * rel[1]
+            self.invalidate(self.layout()[0])
+
+    def box_rect(self, box):
+        x0, y0, x1, y1 = box
+        return self.cell_rect((x0, y0)).union(self.cell_rect((x1 - 1, y1 - 1)))
+
+    def paint(self):
+        box = self.stroke.flush(self.image, self.draw_fg_color, self.draw_bg_color, self.char_map.selected,
+                                self.tool == "erase")
+        if box is not None:
+            self.invalidate(self.box_rect(box))
+
+    def press(self):
+        # Left click on the canvas with the fill tools
+        if self.cursor is None:
+            return
+        if self.tool == "fill":
+            box = flood_fill(self.image, *self.cursor, self.draw_fg_color, self.draw_bg_color,
+                             self.char_map.selected, self.fill_tolerance)
+            self.invalidate(self.box_rect(box))
+        elif self.tool == "select" and self.selection is not None and self.in_selection(self.cursor):
+            self.grab = self.cursor
+        elif self.tool in ("rect", "select"):
+            self.anchor = self.cursor
+            self.selection = None
+
+    def release(self):
+        if self.anchor is not None and self.cursor is not None:
+            if self.tool == "select":
+                x0, x1 = sorted((self.anchor[0], self.cursor[0]))
+                y0, y1 = sorted((self.anchor[1], self.cursor[1]))
+                self.selection = x0, y0, x1 + 1, y1 + 1
+            else:
+                rect_fill(self.image, self.anchor, self.cursor, self.draw_fg_color, self.draw_bg_color,
+                          self.char_map.selected)
+        elif self.grab is not None and self.cursor is not None and self.grab != self.cursor:
+            # Dropped somewhere else, the cells are moved in one write each for cutting and pasting
+            last, before = self.journal.undo_steps[-1] if self.journal.undo_steps else None, self.selection
+            self.selection = move_rect(self.image, self.selection, self.cursor[0] - self.grab[0],
+                                       self.cursor[1] - self.grab[1])
+            self.mark_selection(last, before)
+        if self.anchor is not None or self.grab is not None:
+            self.invalidate(self.layout()[0])
+        self.anchor = None
+        self.grab = None
+
+    def in_selection(self, cell):
+        x0, y0, x1, y1 = self.selection
+        return x0 <= cell[0] < x1 and y0 <= cell[1] < y1
+
+    def clip(self, key):
+        # Ctrl+C copies the selection, Ctrl+X cuts it, Ctrl+V pastes at the cursor or over the selection
+        if key in (pygame.K_c, pygame.K_x) and self.selection is not None:
+            self.clipboard = (copy_rect if key == pygame.K_c else cut_rect)(self.image, *self.selection)
+        elif key == pygame.K_v and self.clipboard is not None:
+            x, y = self.cursor or (self.selection or (0, 0))[:2]
+            last, before = self.journal.undo_steps[-1] if self.journal.undo_steps else None, self.selection
+            self.selection = paste(self.image, self.clipboard, x, y)
+            self.mark_selection(last, before)
+        self.invalidate(self.layout()[0])
+        self.invalidate(self.layout()[2])
+
+    def key(self, event):
+        tools = {pygame.K_b: "brush", pygame.K_e: "erase", pygame.K_f: "fill", pygame.K_r: "rect",
+                 pygame.K_s: "select"}
+        if event.key in tools:
+            self.tool = tools[event.key]
+        elif event.key == pygame.K_ESCAPE:
+            self.selection = None
+            self.invalidate(self.layout()[0])
+        elif event.key == pygame.K_LEFTBRACKET:
+            self.fill_tolerance = max(0, self.fill_tolerance - 8)
+        elif event.key == pygame.K_RIGHTBRACKET:
+            self.fill_tolerance = min(255, self.fill_tolerance + 8)
+        elif event.key == pygame.K_l:
+            self.image.add_layer()
+        elif event.key == pygame.K_DELETE:
+            self.image.remove_layer()
+            self.invalidate(self.layout()[0])
+        elif event.key == pygame.K_h:
+            self.image.show_layer(not self.image.layer.visible)
+            self.invalidate(self.layout()[0])
+        elif event.key in (pygame.K_PAGEUP, pygame.K_PAGEDOWN):
+            self.image.select_frame(self.image.frame + (1 if event.key == pygame.K_PAGEDOWN else -1))
+            self.frame_changed()
+        elif event.key == pygame.K_n:
+            self.image.add_frame()
+            self.frame_changed()
+        elif event.key in (pygame.K_UP, pygame.K_DOWN):
+            step = 1 if event.key == pygame.K_UP else -1
+            self.image.active = min(max(self.image.active + step, 0), len(self.image.layers) - 1)
+        elif event.key == pygame.K_F3:
+            self.profiler.overlay = not self.profiler.overlay
+            # Keeps the numbers fresh, even when nothing else is drawn
+            pygame.time.set_timer(self.overlay_tick, 500 if self.profiler.overlay else 0)
+        elif event.key == pygame.K_F4:
+            if self.profiler.trace is None:
+                self.profiler.start_trace()
+                print("Recording frame trace...")
+            else:
+                path = time.strftime("ansidote-trace-%Y%m%d-%H%M%S.json")
+                self.profiler.stop_trace(path)
+                print(f"Saved frame trace to '{path}'!")
+        self.invalidate(self.layout()[2])
+
+    def frame_changed(self):
+        # Tiles still being rendered in the background belong to the frame shown before
+        self.renderer.cancel(self.image)
+        self.preview = None
+        self.loading = False
+        self.invalidate(self.layout()[0])
+        self.invalidate(self.layout()[2])
+
+    def draw_timeline(self, x, y, width):
+        # One box per frame, the current one highlighted
+        txt = self.font.render(f"Frame {self.image.frame + 1}/{len(self.image.frames)}", 1, (200, 200, 200))
+        self.screen.blit(txt, (x, y + 4))
+        x += txt.get_width() + 8
+        n = len(self.image.frames)
+        box = max(1, min(12, (width - txt.get_width() - 8) // n))
+        for i in range(n):
+            color = (0, 255, 0) if i == self.image.frame else (120, 125, 130)
+            self.screen.fill(color, (x + i * box, y + 6, max(1, box - 2), 12))
+
+    def draw_layer_status(self, x, y):
+        layer = self.image.layer
+        key = (id(layer), layer.version, self.image.w, self.image.h)
+        if self.layer_thumb[0] != key:
+            tw = min(120, max(1, round(24 * self.image.w / (self.image.h * self.image.aspect))))
+            self.layer_thumb = (key, pygame.transform.smoothscale(layer.thumbnail(), (tw, 24)))
+        thumb = self.layer_thumb[1]
+        self.screen.fill((30, 33, 35), (x, y, thumb.get_width(), 24))
+        self.screen.blit(thumb, (x, y))
+        txt = f"{layer.name} ({self.image.active + 1}/{len(self.image.layers)})" + ("" if layer.visible else " hidden")
+        self.screen.blit(self.font.render(txt, 1, (200, 200, 200)), (x + thumb.get_width() + 8, y + 4))
 
-        # Image Grid
+    def redraw(self):
+        canvas, sidebar, status = self.layout()
+        w, h = self.screen.get_width(), self.screen.get_height()
         psx, psy = self.image.px, round(self.image.aspect * self.image.px)
-        sx, sy = self.mx - self.image.w / 2 * psx, self.my - self.image.h / 2 * psy
-        self.screen.blit(self.image.surface, (sx, sy))
-
-        # Sidebar
-        self.draw_sidebar(w - 320, 320, h - 32)
-
-        # Status Bar
-        self.screen.fill((80, 85, 90), (0, h - 32, w, h))
-
-        # Selection
-        x, y = pygame.mouse.get_pos()
-        dx, dy = pygame.mouse.get_rel()
-        if sx < x < sx + self.image.w * psx and sy < y < sy + self.image.h * psy and x < w - 320:
-            self.cursor = mapped_x, mapped_y = int((x - sx) / psx), int((y - sy) / psy)
-            pygame.draw.rect(self.screen, (200, 200, 200), (sx + mapped_x * psx, sy + mapped_y * psy, psx, psy),
-                             width=1)
-            self.screen.blit(self.font.render(f"({mapped_x + 1: 6d},{mapped_y + 1: 6d}) ",
-                                              1, (200, 200, 200)), (16, h - 24))
-            # Are we drawing?
-            if pygame.mouse.get_pressed(3)[0]:
-                self.image.set_pixel(mapped_x, mapped_y,
-                                     self.draw_fg_color, self.draw_bg_color, self.char_map.selected)
-            elif pygame.mouse.get_pressed(3)[2]:
-                # Pick color and symbol from image
-                i = mapped_y * self.image.w + mapped_x
-                self.change_color((self.image.fg_r[i], self.image.fg_g[i], self.image.fg_b[i]), False)
-                self.change_color((self.image.bg_r[i], self.image.bg_g[i], self.image.bg_b[i]), True)
-                self.char_map.selected = self.image.s[i]
-            # Are we moving the image around?
-            elif pygame.mouse.get_pressed(3)[1]:
-                self.mx += 0.5 * dx
-                self.my += 0.5 * dy
-
-        # Flip display with the finished surface
-        pygame.display.flip()
+        sx, sy = self.image_origin()
+
+        # Only repaint what changed, everything else is still on screen
+        for rect in self.dirty:
+            self.screen.set_clip(rect)
+
+            # Image Grid
+            if rect.colliderect(canvas):
+                with self.profiler.span("canvas"):
+                    self.screen.fill((30, 33, 35))
+                    if self.preview is not None:
+                        self.draw_preview(canvas)
+                    else:
+                        self.image.blit(self.screen, (sx, sy), rect.clip(canvas), render=not self.loading)
+
+            # Sidebar
+            if rect.colliderect(sidebar):
+                with self.profiler.span("sidebar"):
+                    self.draw_sidebar(w - 320, 320, h - 32)
+
+            # Status Bar
+            if rect.colliderect(status):
+                self.screen.fill((80, 85, 90), status)
+                tool = f"Tool: {self.tool}" + (f" (tolerance {self.fill_tolerance})" if self.tool == "fill" else "")
+                if self.tool == "select" and self.selection is not None:
+                    tool += f" ({self.selection[2] - self.selection[0]}x{self.selection[3] - self.selection[1]})"
+                self.screen.blit(self.font.render(tool, 1, (200, 200, 200)), (240, h - 24))
+                if self.search is not None:
+                    find = f"Find: {self.search}_ ({len(self.char_map.chars)} found)"
+                    self.screen.blit(self.font.render(find, 1, (200, 200, 200)), (520, h - 24))
+                elif self.files.label is not None:
+                    progress = f"{self.files.label}... {self.files.progress:.0%}"
+                    self.screen.blit(self.font.render(progress, 1, (200, 200, 200)), (520, h - 24))
+                else:
+                    self.draw_layer_status(520, h - 28)
+                self.draw_timeline(w - 312, h - 28, 304)
+                if self.profiler.overlay:
+                    p50, p99 = self.profiler.percentiles()
+                    txt = self.font.render(f"frame p50 {p50:6.2f} ms  p99 {p99:6.2f} ms", 1, (200, 200, 200))
+                    self.screen.blit(txt, (w - 320 - txt.get_width() - 16, h - 24))
+
+            # Rectangle being spanned
+            if self.anchor is not None and self.cursor is not None:
+                ax, bx = sorted((self.anchor[0], self.cursor[0]))
+                ay, by = sorted((self.anchor[1], self.cursor[1]))
+                pygame.draw.rect(self.screen, (200, 200, 200),
+                                 (sx + ax * psx, sy + ay * psy, (bx - ax + 1) * psx, (by - ay + 1) * psy), width=1)
+
+            # Selected block, following the cursor while it is dragged
+            if self.selection is not None:
+                x0, y0, x1, y1 = self.selection
+                if self.grab is not None and self.cursor is not None:
+                    x0, x1 = x0 + self.cursor[0] - self.grab[0], x1 + self.cursor[0] - self.grab[0]
+                    y0, y1 = y0 + self.cursor[1] - self.grab[1], y1 + self.cursor[1] - self.grab[1]
+                pygame.draw.rect(self.screen, (255, 200, 0),
+                                 (sx + x0 * psx, sy + y0 * psy, (x1 - x0) * psx, (y1 - y0) * psy), width=1)
+
+            # Selection
+            if self.cursor is not None:
+                mapped_x, mapped_y = self.cursor
+                pygame.draw.rect(self.screen, (200, 200, 200), (sx + mapped_x * psx, sy + mapped_y * psy, psx, psy),
+                                 width=1)
+                if rect.colliderect(status):
+                    self.screen.blit(self.font.render(f"({mapped_x + 1: 6d},{mapped_y + 1: 6d}) ",
+                                                      1, (200, 200, 200)), (16, h - 24))
+        self.screen.set_clip(None)
+
+        # Push only the changed areas to the display
+        with self.profiler.span("display_update"):
+            pygame.display.update(self.dirty)
+        self.dirty = []
+
+    def handle(self, event):
+        if event.type == pygame.QUIT:
+            pygame.quit()
+            sys.exit()
+        elif event.type in (pygame.WINDOWRESIZED, pygame.WINDOWEXPOSED):
+            if event.type == pygame.WINDOWRESIZED:
+                self.char_map.resize(self.char_map_height())
+            self.invalidate()
+        elif event.type == pygame.WINDOWLEAVE:
+            self.move_cursor((-1, -1))
+        elif event.type == pygame.MOUSEWHEEL:
+            if self.over_char_map(pygame.mouse.get_pos()):
+                if self.char_map.scroll(-3 * event.y):
+                    self.invalidate(self.layout()[1])
+            else:
+                self.zoom(event)
+        elif event.type in (self.overlay_tick, self.file_tick):
+            self.invalidate(self.layout()[2])
+        elif event.type == self.file_done:
+            self.file_finished(event)
+        elif event.type == self.autosave_tick:
+            self.autosave()
+        elif event.type == self.collab_event and self.collab is not None:
+            if self.collab.collect(self.image):
+                self.invalidate(self.layout()[0])
+            if self.collab.error is not None:
+                # Drawing goes on alone, nothing is shared anymore
+                print(f"Lost connection to '{self.collab.address}': {self.collab.error or 'closed'}")
+                self.collab = None
+                self.image.sync = None
+        elif event.type == self.tiles_ready:
+            if event.error is not None:
+                print(f"Could not render tiles: {event.error}")
+            if self.renderer.collect(self.image):
+                self.preview = None
+                self.loading = False
+                self.invalidate(self.layout()[0])
+        elif event.type == pygame.MOUSEMOTION:
+            self.move_cursor(event.pos)
+            self.use_cursor(event.buttons, event.rel)
+        elif event.type == pygame.MOUSEBUTTONDOWN:
+            # Everything painted until the button is released is undone in one go
+            if event.button == 1:
+                self.journal.begin()
+            self.move_cursor(event.pos)
+            if event.button == 1 and self.tool not in ("brush", "erase"):
+                self.press()
+            self.use_cursor([event.button == n for n in (1, 2, 3)])
+        elif event.type == pygame.MOUSEBUTTONUP:
+            if event.button == 1:
+                self.paint()
+                self.stroke.lift()
+                self.release()
+                self.journal.end(self.image)
+            self.mouse(event)
+        elif event.type == pygame.KEYDOWN and self.search is not None:
+            self.find_char(event)
+        elif event.type == pygame.KEYDOWN and event.mod & pygame.KMOD_CTRL:
+            if event.key == pygame.K_DELETE:
+                self.image.remove_frame()
+                self.frame_changed()
+            elif event.key == pygame.K_f:
+                self.search = self.char_map.query
+                self.invalidate(self.layout()[2])
+            elif event.key == pygame.K_z:
+                self.undo(redo=bool(event.mod & pygame.KMOD_SHIFT))
+            elif event.key == pygame.K_y:
+                self.undo(redo=True)
+            elif event.key in (pygame.K_c, pygame.K_x, pygame.K_v):
+                self.clip(event.key)
+        elif event.type == pygame.KEYDOWN:
+            self.key(event)
 
     def run(self):
+        # The window shows up with the sidebar right away, the canvas follows once its tiles are rendered
+        self.loading = self.request_tiles()
+        self.invalidate()
         while True:
-            resizing = False
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    sys.exit()
-                elif event.type == pygame.WINDOWRESIZED:
-                    resizing = True
-                elif event.type == pygame.MOUSEWHEEL:
-                    self.zoom(event)
-                elif event.type == pygame.MOUSEBUTTONUP:
-                    self.mouse(event)
-            if not resizing:
-                self.redraw()
-            self.clock.tick(60)
+            if self.dirty:
+                with self.profiler.span("redraw"):
+                    self.redraw()
+                self.profiler.end_frame()
+                self.clock.tick(60)
+            events = pygame.event.get()
+            if not events and not self.dirty:
+                # Nothing to do, sleep until something happens
+                events = [pygame.event.wait(500)] + pygame.event.get()
+            self.profiler.begin_frame()
+            with self.profiler.span("events"):
+                for event in events:
+                    self.handle(event)
+            with self.profiler.span("paint"):
+                self.paint()
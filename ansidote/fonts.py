@@ -0,0 +1,70 @@
+"""
+ansi.e -  A simple ANSI art editor.
+Copyright (C) 2024 Dominik Behrens
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the Lesser GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import json
+import pygame
+
+# Try some of these before giving up
+MONOSPACE_FONTS = ["Hack", "Source Code Pro", "Consolas", "Lucida Console", "Courier New", "Monospace"]
+
+
+def cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "ansidote")
+
+
+def font_cache_path():
+    return os.path.join(cache_dir(), "font.json")
+
+
+def resolve_font():
+    for font in MONOSPACE_FONTS:
+        path = pygame.font.match_font(font)
+        if path is not None and os.path.exists(path):
+            return path
+    # The font pygame ships with, as a full path so it can be checked for changes like any other
+    path = os.path.join(os.path.dirname(pygame.font.__file__), pygame.font.get_default_font())
+    return path if os.path.exists(path) else pygame.font.get_default_font()
+
+
+def find_font():
+    # Asking fontconfig can take a while, the answer is kept on disk until the font file changes
+    cache = font_cache_path()
+    try:
+        with open(cache) as f:
+            cached = json.load(f)
+        stat = os.stat(cached["path"])
+        if cached["fonts"] == MONOSPACE_FONTS and [stat.st_mtime, stat.st_size] == cached["stamp"]:
+            return cached["path"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    path = resolve_font()
+    try:
+        stat = os.stat(path)
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        with open(cache, "w") as f:
+            json.dump({"fonts": MONOSPACE_FONTS, "path": path, "stamp": [stat.st_mtime, stat.st_size]}, f)
+    except OSError:
+        pass
+    return path
+
+
+def load_font(size=16):
+    if not pygame.font.get_init():
+        pygame.font.init()
+    return pygame.font.Font(find_font(), size)
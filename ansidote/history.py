@@ -0,0 +1,208 @@
+"""
+ansi.e -  A simple ANSI art editor.
+Copyright (C) 2024 Dominik Behrens
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the Lesser GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import numpy as np
+
+from collections import deque
+
+
+def gather(layer, index):
+    # take is quickest with native indices, index itself is kept as it came
+    at = index.astype(np.intp)
+    return (index, np.take(layer.fg.reshape(-1, 3), at, axis=0), np.take(layer.bg.reshape(-1, 3), at, axis=0),
+            np.take(layer.ch.reshape(-1), at), np.take(layer.mask.reshape(-1), at))
+
+
+def gather_box(layer, x0, y0, where):
+    # The planes of layer in the box at x0, y0 the size of where, which says which of its cells count
+    y1, x1 = y0 + where.shape[0], x0 + where.shape[1]
+    return ((x0, y0, where.copy()), layer.fg[y0:y1, x0:x1].copy(), layer.bg[y0:y1, x0:x1].copy(),
+            layer.ch[y0:y1, x0:x1].copy(), layer.mask[y0:y1, x0:x1].copy())
+
+
+def box_to_index(record, w):
+    # A box record as flat indices into a canvas w cells wide, with the values of the cells that count
+    (x0, y0, where), values = record[0], record[1:]
+    ys, xs = np.nonzero(where)
+    return (((ys + y0) * w + xs + x0).astype("u4"),) + tuple(a[where] for a in values)
+
+
+class Step:
+    def __init__(self, layer, index, old, new):
+        # Flat cell indices of layer with the (fg, bg, ch, mask) values before and after the step
+        self.layer = layer
+        self.index = index
+        self.old = old
+        self.new = new
+        # Boxes of the selection before and after, for steps that moved it
+        self.selection = None
+        self.nbytes = index.nbytes + sum(a.nbytes for a in old) + sum(a.nbytes for a in new)
+
+    def write(self, image, values):
+        image.write_cells(self.index, *values[:3], record=False, layer=self.layer, mask=values[3])
+
+    def crop(self, w, h, new_w, new_h):
+        y, x = np.divmod(self.index, w)
+        keep = (x < min(w, new_w)) & (y < min(h, new_h))
+        self.index = (y[keep] * new_w + x[keep]).astype("u4")
+        self.old, self.new = tuple(a[keep] for a in self.old), tuple(a[keep] for a in self.new)
+        return len(self.index) > 0
+
+    def reframe(self, w, h, new_w, new_h):
+        kept = self.crop(w, h, new_w, new_h)
+        self.nbytes = self.index.nbytes + sum(a.nbytes for a in self.old) + sum(a.nbytes for a in self.new or ())
+        # A paste without a selection has none before it
+        fits = all(b is None or (b[2] <= new_w and b[3] <= new_h) for b in self.selection or ())
+        if not fits:
+            self.selection = None
+        return kept
+
+
+class BoxStep(Step):
+    def __init__(self, layer, x0, y0, where, old):
+        # Like Step, but the cells are those set in where, a bool array the size of the box at x0, y0, and the
+        # values are the planes of the whole box. Flat indices are only made when it is written back.
+        # Steps are undone last first, so the box still holds the new values when this one is undone the first
+        # time, they are only copied then
+        super().__init__(layer, where, old, ())
+        self.x0, self.y0 = x0, y0
+        self.new = None
+
+    def write(self, image, values):
+        if self.new is None:
+            self.new = gather_box(self.layer, self.x0, self.y0, self.index)[1:]
+            self.nbytes += sum(a.nbytes for a in self.new)
+        image.write_box(self.x0, self.y0, self.index, *values[:3], record=False, layer=self.layer, mask=values[3])
+
+    def crop(self, w, h, new_w, new_h):
+        bw, bh = max(0, min(w, new_w) - self.x0), max(0, min(h, new_h) - self.y0)
+        self.index = self.index[:bh, :bw]
+        self.old = tuple(a[:bh, :bw] for a in self.old)
+        if self.new is not None:
+            self.new = tuple(a[:bh, :bw] for a in self.new)
+        return bool(self.index.any())
+
+
+class Journal:
+    def __init__(self, budget=64 * 1024 * 1024):
+        self.budget = budget
+        self.size = 0
+        self.undo_steps = deque()
+        self.redo_steps = list()
+        self.open = False
+        self.pending = list()
+        self.layer = None
+
+    def clear(self):
+        self.undo_steps.clear()
+        self.redo_steps.clear()
+        self.pending.clear()
+        self.open = False
+        self.size = 0
+
+    def resize(self, w, h, new_w, new_h):
+        # The canvas changed size, the steps keep the cells that are still on it at their new indices
+        for steps in (self.undo_steps, self.redo_steps):
+            kept = [step for step in steps if step.reframe(w, h, new_w, new_h)]
+            steps.clear()
+            steps.extend(kept)
+        self.size = sum(s.nbytes for s in self.undo_steps) + sum(s.nbytes for s in self.redo_steps)
+
+    def begin(self):
+        self.open = True
+
+    def record(self, image, index):
+        # Remember the values before they get overwritten, the first write of a cell wins when the step ends
+        index = np.asarray(index, dtype="u4").ravel()
+        self.layer = image.layer
+        self.pending.append(gather(self.layer, index))
+
+    def record_box(self, image, x0, y0, where):
+        # Same as record for the cells set in where, a bool array the size of the box at x0, y0
+        self.layer = image.layer
+        self.pending.append(gather_box(self.layer, x0, y0, where))
+
+    def end(self, image):
+        self.open = False
+        if not self.pending:
+            return
+        if len(self.pending) == 1 and type(self.pending[0][0]) is tuple:
+            self.end_box()
+            return
+        # Boxes among other writes become flat indices like the rest
+        self.pending = [box_to_index(p, image.w) if type(p[0]) is tuple else p for p in self.pending]
+        if len(self.pending) == 1:
+            index, old = self.pending[0][0], self.pending[0][1:]
+        else:
+            index = np.concatenate([p[0] for p in self.pending])
+            old = tuple(np.concatenate([p[n] for p in self.pending]) for n in (1, 2, 3, 4))
+        if len(self.pending) > 1 or (index[1:] <= index[:-1]).any():
+            index, first = np.unique(index, return_index=True)
+            old = tuple(a[first] for a in old)
+        self.pending.clear()
+        new = gather(self.layer, index)[1:]
+        # Colors compared as one 3 byte value per cell
+        changed = (old[2] != new[2]) | (old[3] != new[3])
+        for o, n in zip(old[:2], new[:2]):
+            changed |= np.ascontiguousarray(o).view("V3").ravel() != np.ascontiguousarray(n).view("V3").ravel()
+        if not changed.any():
+            return
+        if not changed.all():
+            index, old, new = index[changed], tuple(a[changed] for a in old), tuple(a[changed] for a in new)
+        self.push(Step(self.layer, index, old, new))
+
+    def end_box(self):
+        # A single box is kept as one, only the cells in it that changed count
+        (x0, y0, where), old = self.pending[0][0], self.pending[0][1:]
+        self.pending.clear()
+        y1, x1 = y0 + where.shape[0], x0 + where.shape[1]
+        new = tuple(getattr(self.layer, name)[y0:y1, x0:x1] for name in ("fg", "bg", "ch", "mask"))
+        changed = (old[2] != new[2]) | (old[3] != new[3])
+        for o, n in zip(old[:2], new[:2]):
+            # Channels or'ed one by one, any over the last axis is several times slower
+            differs = o != n
+            changed |= differs[..., 0] | differs[..., 1] | differs[..., 2]
+        changed &= where
+        if changed.any():
+            self.push(BoxStep(self.layer, x0, y0, changed, old))
+
+    def push(self, step):
+        # Anything undone so far can't be redone after a new step
+        self.size -= sum(s.nbytes for s in self.redo_steps)
+        self.redo_steps.clear()
+        self.undo_steps.append(step)
+        self.size += step.nbytes
+        while self.size > self.budget and len(self.undo_steps) > 1:
+            self.size -= self.undo_steps.popleft().nbytes
+
+    def undo(self, image):
+        if not self.undo_steps:
+            return None
+        step = self.undo_steps.pop()
+        nbytes = step.nbytes
+        step.write(image, step.old)
+        self.size += step.nbytes - nbytes
+        self.redo_steps.append(step)
+        return step
+
+    def redo(self, image):
+        if not self.redo_steps:
+            return None
+        step = self.redo_steps.pop()
+        step.write(image, step.new)
+        self.undo_steps.append(step)
+        return step
@@ -15,146 +15,860 @@ GNU Lesser General Public License for more details.
 You should have received a copy of the Lesser GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+import os
+import re
+import itertools
+import threading
 import pygame
 import numpy as np
 
+from collections import OrderedDict
+from ansidote.colors import VGA_16, XTERM_256, DEFAULT_FG, DEFAULT_BG, quantize
+
+
+class GlyphAtlas:
+    def __init__(self, font: pygame.font.Font, levels=4):
+        self.font = font
+        # Each zoom level keeps its own set of masks, least recently used level goes first
+        self.levels = levels
+        self.cache = OrderedDict()
+        # Tiles may be rendered off the main thread
+        self.lock = threading.RLock()
+
+    def mask(self, s, size):
+        with self.lock:
+            return self._mask(s, size)
+
+    def _mask(self, s, size):
+        glyphs = self.cache.get(size)
+        if glyphs is None:
+            glyphs = self.cache[size] = dict()
+            if len(self.cache) > self.levels:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(size)
+        mask = glyphs.get(s)
+        if mask is None:
+            # White glyph on a transparent background, so the alpha channel is the coverage
+            srf = self.font.render(s, 1, (255, 255, 255))
+            mask = glyphs[s] = pygame.transform.scale(srf, size)
+        return mask
+
+    def masks(self, chars, size):
+        # The masks of chars at size, held on to by whoever renders without the font
+        with self.lock:
+            return {s: self._mask(s, size) for s in chars}
+
+    def blit(self, surface, s, color, pos, size, masks=None):
+        # With masks given only those are used, characters missing from them are left out
+        mask = self.mask(s, size) if masks is None else masks.get(s)
+        if mask is None:
+            return
+        srf = mask.copy()
+        srf.fill(color, special_flags=pygame.BLEND_RGB_MULT)
+        surface.blit(srf, pos)
+
+
+class TileCache:
+    def __init__(self, budget=64 * 1024 * 1024):
+        # Rendered tiles keyed by (px, tx, ty), least recently used tiles go first once over budget
+        self.budget = budget
+        self.size = 0
+        self.tiles = OrderedDict()
+        # Number of tiles cached for each zoom level
+        self.levels = dict()
+
+    def get(self, key):
+        srf = self.tiles.get(key)
+        if srf is not None:
+            self.tiles.move_to_end(key)
+        return srf
+
+    def put(self, key, srf):
+        self.discard(key)
+        self.tiles[key] = srf
+        self.size += srf.get_width() * srf.get_height() * srf.get_bytesize()
+        self.levels[key[0]] = self.levels.get(key[0], 0) + 1
+        while self.size > self.budget and len(self.tiles) > 1:
+            self.discard(next(iter(self.tiles)))
+
+    def discard(self, key):
+        srf = self.tiles.pop(key, None)
+        if srf is not None:
+            self.size -= srf.get_width() * srf.get_height() * srf.get_bytesize()
+            self.levels[key[0]] -= 1
+            if not self.levels[key[0]]:
+                del self.levels[key[0]]
+
+    def clear(self):
+        self.tiles.clear()
+        self.levels.clear()
+        self.size = 0
+
+
+_layer_ids = itertools.count()
+
+
+class Layer:
+    def __init__(self, w, h, name="Background", planes=None):
+        self.name = name
+        self.visible = True
+        self.w, self.h = w, h
+        if planes is None:
+            self.fg = np.zeros((h, w, 3), dtype="u1")
+            self.bg = np.zeros((h, w, 3), dtype="u1")
+            self.ch = np.full((h, w), 32, dtype="u4")
+            # Cells this layer covers, the layers below show through everywhere else
+            self.mask = np.zeros((h, w), dtype=bool)
+        else:
+            self.fg, self.bg, self.ch, self.mask = planes
+        # Every write bumps version and stamps the rows it touched, so any save can tell what changed since
+        self.uid = next(_layer_ids)
+        self.version = 0
+        self.rows = np.zeros(h, dtype="u8")
+        # One pixel per cell, redrawn only where the layer changed since it was last asked for
+        self.surface = None
+        self.dirty = None
+
+    def copy(self):
+        layer = Layer(self.w, self.h, self.name)
+        layer.visible = self.visible
+        np.copyto(layer.fg, self.fg)
+        np.copyto(layer.bg, self.bg)
+        np.copyto(layer.ch, self.ch)
+        np.copyto(layer.mask, self.mask)
+        return layer
+
+    def resize(self, w, h):
+        # Cells keep their place, cut off or padded with blank cells on the right and bottom
+        cw, ch = min(w, self.w), min(h, self.h)
+        for plane in ("fg", "bg", "ch", "mask"):
+            old = getattr(self, plane)
+            new = np.full((h, w), 32, dtype="u4") if plane == "ch" else np.zeros((h, w) + old.shape[2:], old.dtype)
+            new[:ch, :cw] = old[:ch, :cw]
+            setattr(self, plane, new)
+        self.w, self.h = w, h
+        self.version += 1
+        self.rows = np.full(h, self.version, dtype="u8")
+        self.surface = None
+        self.dirty = None
+
+    def touch(self, x0, y0, x1, y1):
+        if self.dirty is not None:
+            x0, y0 = min(x0, self.dirty[0]), min(y0, self.dirty[1])
+            x1, y1 = max(x1, self.dirty[2]), max(y1, self.dirty[3])
+        self.dirty = (x0, y0, x1, y1)
+        self.version += 1
+        self.rows[y0:y1] = self.version
+
+    def thumbnail(self):
+        # Cells in their glyph or background color, transparent where the layer doesn't cover anything
+        if self.surface is None:
+            self.surface = pygame.Surface((self.w, self.h), pygame.SRCALPHA)
+            self.dirty = (0, 0, self.w, self.h)
+        if self.dirty is not None:
+            x0, y0, x1, y1 = self.dirty
+            glyph = self.ch[y0:y1, x0:x1, None] > 32
+            colors = np.where(glyph, self.fg[y0:y1, x0:x1], self.bg[y0:y1, x0:x1])
+            pygame.surfarray.pixels3d(self.surface)[x0:x1, y0:y1] = colors.transpose(1, 0, 2)
+            pygame.surfarray.pixels_alpha(self.surface)[x0:x1, y0:y1] = self.mask[y0:y1, x0:x1].T * 255
+            self.dirty = None
+        return self.surface
+
 
 class Image:
-    def __init__(self, w, h, font: pygame.font.Font):
+    # Tiles are roughly this many pixels wide and high, whatever the zoom level
+    tile_pixels = 256
+    max_px = 128
+
+    def __init__(self, w, h, font: pygame.font.Font, frames=None):
         self.draw_border = False
         fs = font.size(" ")
         self.px = fs[0]
         self.aspect = fs[1] / fs[0]
         self.w, self.h = w, h
-        self.bg_r = np.zeros(w * h, dtype="u4")
-        self.bg_g = np.zeros(w * h, dtype="u4")
-        self.bg_b = np.zeros(w * h, dtype="u4")
-        self.fg_r = np.zeros(w * h, dtype="u4")
-        self.fg_g = np.zeros(w * h, dtype="u4")
-        self.fg_b = np.zeros(w * h, dtype="u4")
-        self.s = np.zeros(w * h, dtype=("str", 1))
+        # Frames of an animation, each a stack of layers from the bottom up. The bottom layer covers every cell,
+        # writes go to the active layer of the current frame
+        if frames is None:
+            frames = [[Layer(w, h)]]
+            frames[0][0].mask[...] = True
+        self.frames = frames
+        self.frame = 0
+        self.layers = self.frames[0]
+        self.active = 0
+        # Cell planes of what is visible: 8 bit rgb colors and unicode code points, row major.
+        # A single layer shares its planes, with more they hold the composite of all visible layers
+        self.fg, self.bg, self.ch = flatten(self.layers)
         self.font = font
-        self.surface = None
-        self.redraw()
+        self.atlas = GlyphAtlas(font)
+        self.tiles = TileCache()
+        # Undo journal, if anyone is listening
+        self.journal = None
+        # Collaboration client that shares every write with the others, if connected
+        self.sync = None
+        # Native file the image was opened from or last saved to, as returned by save_native. Saving there again
+        # writes the changes only
+        self.native = None
+        # Cells changed while tiles are rendered in the background, as (x0, y0, x1, y1) boxes
+        self.damage = None
+
+    def cell_size(self, px=None):
+        px = self.px if px is None else px
+        return px, round(self.aspect * px)
+
+    def tile_cells(self, px=None):
+        px, py = self.cell_size(px)
+        return max(1, self.tile_pixels // px), max(1, self.tile_pixels // py)
 
     def redraw(self):
-        py = round(self.aspect * self.px)
-        self.surface = pygame.Surface((self.w * self.px, self.h * py))
-        for row in range(self.h):
-            for column in range(self.w):
-                r, g, b, s = (int(self.bg_r[row * self.w + column]),
-                              int(self.bg_g[row * self.w + column]),
-                              int(self.bg_b[row * self.w + column]),
-                              str(self.s[row * self.w + column]))
-                pygame.draw.rect(self.surface, (r, g, b),
-                                 (column * self.px, row * py, self.px, py))
-                if s != " ":
-                    r, g, b = (int(self.fg_r[row * self.w + column]),
-                               int(self.fg_g[row * self.w + column]),
-                               int(self.fg_b[row * self.w + column]))
-                    srf = self.font.render(s, 1, (r, g, b))
-                    srf = pygame.transform.scale(srf, (self.px, py))
-                    self.surface.blit(srf, (column * self.px, row * py, self.px + 1, py + 1))
-                if self.draw_border:
-                    pygame.draw.rect(self.surface, (80, 80, 80),
-                                     (column * self.px, row * py, self.px, py),
-                                     width=1)
+        # Tiles are rendered again lazily, once they become visible
+        self.tiles.clear()
+
+    def render_region(self, surface, x0, y0, x1, y1, ox=0, oy=0, px=None, planes=None, masks=None):
+        # planes and masks are what render_tile got, if anything
+        px, py = self.cell_size(px)
+        fg, bg, ch = (self.fg, self.bg, self.ch) if planes is None else planes
+
+        # Backgrounds in one go, each cell expanded to its pixel block (surfarray is column-major)
+        pixels = np.repeat(np.repeat(bg[y0:y1, x0:x1], py, axis=0), px, axis=1)
+        view = pygame.surfarray.pixels3d(surface)
+        view[ox:ox + pixels.shape[1], oy:oy + pixels.shape[0]] = pixels.transpose(1, 0, 2)
+        del view
+
+        # Glyphs only where there is something to draw
+        ch, fg = ch[y0:y1, x0:x1], fg[y0:y1, x0:x1]
+        for row, column in zip(*np.nonzero(ch > 32)):
+            self.atlas.blit(surface, chr(ch[row, column]), tuple(fg[row, column].tolist()),
+                            (ox + column * px, oy + row * py), (px, py), masks)
 
-    def set_pixel(self, x, y, fg, bg, s):
-        r, g, b = bg
-        self.bg_r[y * self.w + x] = r
-        self.bg_g[y * self.w + x] = g
-        self.bg_b[y * self.w + x] = b
-        self.s[y * self.w + x] = s
-        py = round(self.px * self.aspect)
-        pygame.draw.rect(self.surface, (r, g, b), (x * self.px, y * py, self.px + 1, py + 1))
-        if s != " ":
-            r, g, b, = fg
-            self.fg_r[y * self.w + x] = r
-            self.fg_g[y * self.w + x] = g
-            self.fg_b[y * self.w + x] = b
-            srf = self.font.render(s, 1, (r, g, b))
-            srf = pygame.transform.scale(srf, (self.px, py))
-            self.surface.blit(srf, (x * self.px, y * py, self.px + 1, py + 1))
         if self.draw_border:
-            pygame.draw.rect(self.surface, (80, 80, 80), (x * self.px, y * py, self.px + 1, py + 1), width=1)
+            view = pygame.surfarray.pixels3d(surface)[ox:ox + (x1 - x0) * px, oy:oy + (y1 - y0) * py]
+            xs, ys = np.arange(view.shape[0]), np.arange(view.shape[1])
+            view[(xs % px == 0) | (xs % px == px - 1), :] = 80
+            view[:, (ys % py == 0) | (ys % py == py - 1)] = 80
+            del view
+
+    def tile_bounds(self, tx, ty, px=None):
+        cols, rows = self.tile_cells(px)
+        x0, y0 = tx * cols, ty * rows
+        return x0, y0, min(self.w, x0 + cols), min(self.h, y0 + rows)
+
+    def render_tile(self, tx, ty, px=None, planes=None, masks=None):
+        # Off the main thread with the (fg, bg, ch) planes and glyph masks taken when the tile was asked for,
+        # the image may have swapped its own since
+        px, py = self.cell_size(px)
+        x0, y0, x1, y1 = self.tile_bounds(tx, ty, px)
+        srf = pygame.Surface(((x1 - x0) * px, (y1 - y0) * py))
+        self.render_region(srf, x0, y0, x1, y1, px=px, planes=planes, masks=masks)
+        return srf
+
+    def tile(self, tx, ty):
+        key = (self.px, tx, ty)
+        srf = self.tiles.get(key)
+        if srf is None:
+            srf = self.render_tile(tx, ty)
+            self.tiles.put(key, srf)
+        return srf
+
+    def visible_tiles(self, origin, area, px=None):
+        # Tiles overlapping area when the canvas has its top left corner at origin
+        px, py = self.cell_size(px)
+        cols, rows = self.tile_cells(px)
+        tw, th = cols * px, rows * py
+        ox, oy = int(origin[0]), int(origin[1])
+        area = pygame.Rect(area).clip((ox, oy, self.w * px, self.h * py))
+        if area.width == 0 or area.height == 0:
+            return []
+        return [(tx, ty, ox + tx * tw, oy + ty * th)
+                for ty in range((area.top - oy) // th, (area.bottom - 1 - oy) // th + 1)
+                for tx in range((area.left - ox) // tw, (area.right - 1 - ox) // tw + 1)]
+
+    def blit(self, surface, origin, area, render=True):
+        # Draw the canvas with its top left corner at origin, but only the tiles that overlap area
+        for tx, ty, x, y in self.visible_tiles(origin, area):
+            if render:
+                surface.blit(self.tile(tx, ty), (x, y))
+            elif (self.px, tx, ty) in self.tiles.tiles:
+                surface.blit(self.tiles.get((self.px, tx, ty)), (x, y))
+
+    def render(self):
+        # The whole canvas on one surface, for exports
+        px, py = self.cell_size()
+        surface = pygame.Surface((self.w * px, self.h * py))
+        self.render_region(surface, 0, 0, self.w, self.h)
+        return surface
+
+    def invalidate_cells(self, x0, y0, x1, y1):
+        # Cached tiles of the current zoom level get the cells redrawn, other levels are dropped.
+        # Only the tiles over the cells are looked up, however many are cached
+        if self.damage is not None:
+            self.damage.append((x0, y0, x1, y1))
+        if x0 >= x1 or y0 >= y1:
+            return
+        for level in list(self.tiles.levels):
+            cols, rows = self.tile_cells(level)
+            for ty in range(y0 // rows, (y1 - 1) // rows + 1):
+                for tx in range(x0 // cols, (x1 - 1) // cols + 1):
+                    key = (level, tx, ty)
+                    if key not in self.tiles.tiles:
+                        continue
+                    if level != self.px:
+                        self.tiles.discard(key)
+                        continue
+                    tx0, ty0, tx1, ty1 = self.tile_bounds(tx, ty)
+                    cx0, cy0, cx1, cy1 = max(x0, tx0), max(y0, ty0), min(x1, tx1), min(y1, ty1)
+                    px, py = self.cell_size()
+                    self.render_region(self.tiles.tiles[key], cx0, cy0, cx1, cy1, (cx0 - tx0) * px,
+                                       (cy0 - ty0) * py)
+
+    @property
+    def layer(self):
+        return self.layers[self.active]
+
+    def add_layer(self, name=None):
+        # New, empty layer right above the active one, which it becomes
+        if len(self.layers) == 1:
+            self.fg, self.bg, self.ch = self.fg.copy(), self.bg.copy(), self.ch.copy()
+        layer = Layer(self.w, self.h, name or f"Layer {len(self.layers) + 1}")
+        self.active += 1
+        self.layers.insert(self.active, layer)
+        return layer
+
+    def remove_layer(self):
+        # The active layer goes away, the last one stays
+        if len(self.layers) == 1:
+            return
+        del self.layers[self.active]
+        self.active = max(0, self.active - 1)
+        self.layers[0].mask[...] = True
+        self.layers[0].touch(0, 0, self.w, self.h)
+        if len(self.layers) == 1:
+            self.layers[0].visible = True
+            self.fg, self.bg, self.ch = self.layers[0].fg, self.layers[0].bg, self.layers[0].ch
+        self.composite()
+        self.redraw()
+
+    def show_layer(self, visible):
+        if len(self.layers) > 1 and self.layer.visible != visible:
+            self.layer.visible = visible
+            self.composite()
+            self.redraw()
+
+    def composite(self, index=None):
+        # The topmost visible layer covering a cell is what shows, for all cells or the flat indices given
+        if len(self.layers) == 1:
+            return
+        if index is None:
+            flatten(self.layers, (self.fg, self.bg, self.ch))
+            return
+        fg, bg, ch = self.fg.reshape(-1, 3), self.bg.reshape(-1, 3), self.ch.reshape(-1)
+        base = self.layers[0]
+        if base.visible:
+            fg[index] = base.fg.reshape(-1, 3)[index]
+            bg[index] = base.bg.reshape(-1, 3)[index]
+            ch[index] = base.ch.reshape(-1)[index]
+        else:
+            fg[index], bg[index], ch[index] = 0, 0, 32
+        for layer in self.layers[1:]:
+            if layer.visible:
+                covered = index[layer.mask.reshape(-1)[index]]
+                fg[covered] = layer.fg.reshape(-1, 3)[covered]
+                bg[covered] = layer.bg.reshape(-1, 3)[covered]
+                ch[covered] = layer.ch.reshape(-1)[covered]
+
+    def select_frame(self, frame):
+        self.frame = min(max(frame, 0), len(self.frames) - 1)
+        self.layers = self.frames[self.frame]
+        self.active = min(self.active, len(self.layers) - 1)
+        self.fg, self.bg, self.ch = flatten(self.layers)
+        self.redraw()
+
+    def add_frame(self):
+        # A copy of the current frame right after it, which becomes the current one
+        self.frames.insert(self.frame + 1, [layer.copy() for layer in self.layers])
+        self.select_frame(self.frame + 1)
+
+    def remove_frame(self):
+        if len(self.frames) > 1:
+            del self.frames[self.frame]
+            self.select_frame(self.frame)
+
+    def resize_canvas(self, w, h):
+        # The layers are resized in place, so the history still refers to them. It is reframed first,
+        # nothing has changed yet if that fails
+        if self.journal is not None:
+            self.journal.resize(self.w, self.h, w, h)
+        for layers in self.frames:
+            for layer in layers:
+                layer.resize(w, h)
+            # The bottom layer covers new cells too
+            layers[0].mask[...] = True
+        self.w, self.h = w, h
+        self.damage = None
+        self.select_frame(self.frame)
+
+    def snapshot(self):
+        # A copy to save from while editing goes on, its layers pass for the originals when saved
+        frames = []
+        for layers in self.frames:
+            frames.append([])
+            for layer in layers:
+                copy = layer.copy()
+                copy.uid, copy.version = layer.uid, layer.version
+                np.copyto(copy.rows, layer.rows)
+                frames[-1].append(copy)
+        image = Image(self.w, self.h, self.font, frames=frames)
+        image.native = self.native
+        return image
+
+    def use_font(self, font):
+        # Glyphs come from font from now on, e.g. after loading with the font of another thread
+        self.font = font
+        self.atlas = GlyphAtlas(font)
+        self.redraw()
+
+    def get_cell(self, x, y):
+        return tuple(self.fg[y, x].tolist()), tuple(self.bg[y, x].tolist()), chr(self.ch[y, x])
+
+    def invalidate_index(self, index):
+        # A few scattered cells are redrawn one by one, anything else as their bounding box
+        ys, xs = np.divmod(index, self.w)
+        if len(index) <= 64:
+            for x, y in zip(xs.tolist(), ys.tolist()):
+                self.invalidate_cells(x, y, x + 1, y + 1)
+        elif len(index) > 0:
+            self.invalidate_cells(int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)
+
+    def write_cells(self, index, fg=None, bg=None, ch=None, record=True, layer=None, mask=True):
+        # Flat cell indices of the active layer (or layer), values are broadcast over them,
+        # None leaves a plane untouched. mask says whether the cells cover the layers below afterwards
+        index = np.asarray(index, dtype="u4").ravel()
+        layer = self.layer if layer is None else layer
+        journal = self.journal if record else None
+        if journal is not None:
+            journal.record(self, index)
+        if fg is not None:
+            layer.fg.reshape(-1, 3)[index] = fg
+        if bg is not None:
+            layer.bg.reshape(-1, 3)[index] = bg
+        if ch is not None:
+            layer.ch.reshape(-1)[index] = ch
+        layer.mask.reshape(-1)[index] = mask
+        if journal is not None and not journal.open:
+            journal.end(self)
+        if len(index) > 0:
+            ys, xs = np.divmod(index, self.w)
+            layer.touch(int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)
+        self.composite(index)
+        if self.sync is not None:
+            self.sync.send(self, index)
+        self.invalidate_index(index)
+
+    def write_rect(self, x0, y0, x1, y1, fg=None, bg=None, ch=None, record=True, layer=None, mask=True):
+        # Same as write_cells for the block of cells [x0, x1) x [y0, y1), written by slice assignment
+        layer = self.layer if layer is None else layer
+        journal = self.journal if record else None
+        if journal is not None or len(self.layers) > 1 or self.sync is not None:
+            index = (np.arange(y0, y1)[:, None] * self.w + np.arange(x0, x1)).ravel()
+        if journal is not None:
+            journal.record(self, index)
+        if fg is not None:
+            layer.fg[y0:y1, x0:x1] = fg
+        if bg is not None:
+            layer.bg[y0:y1, x0:x1] = bg
+        if ch is not None:
+            layer.ch[y0:y1, x0:x1] = ch
+        layer.mask[y0:y1, x0:x1] = mask
+        if journal is not None and not journal.open:
+            journal.end(self)
+        layer.touch(x0, y0, x1, y1)
+        if len(self.layers) > 1:
+            self.composite(index)
+        if self.sync is not None:
+            self.sync.send(self, index)
+        self.invalidate_cells(x0, y0, x1, y1)
+
+    def write_masked(self, where, fg=None, bg=None, ch=None, record=True):
+        # Same as write_cells for the cells set in the (h, w) bool array where, written through the mask inside
+        # its bounding box. Returns the box or None
+        rows, columns = np.flatnonzero(where.any(axis=1)), np.flatnonzero(where.any(axis=0))
+        if len(rows) == 0:
+            return None
+        x0, y0, x1, y1 = int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1
+        self.write_box(x0, y0, where[y0:y1, x0:x1], fg, bg, ch, record)
+        return x0, y0, x1, y1
+
+    def write_box(self, x0, y0, where, fg=None, bg=None, ch=None, record=True, layer=None, mask=True):
+        # Same as write_cells for the cells set in where, a bool array the size of the box at x0, y0. Values
+        # are broadcast over the box or come as arrays of its size. The journal keeps the box as it is,
+        # flat indices are only made for compositing and sharing
+        y1, x1 = y0 + where.shape[0], x0 + where.shape[1]
+        layer = self.layer if layer is None else layer
+        journal = self.journal if record else None
+        if journal is not None:
+            journal.record_box(self, x0, y0, where)
+        for plane, value in ((layer.fg, fg), (layer.bg, bg)):
+            if value is not None:
+                # Channel by channel, a where broadcast over the channels is several times slower
+                value = np.asarray(value, dtype="u1")
+                for c in range(3):
+                    np.copyto(plane[y0:y1, x0:x1, c], value[..., c], where=where)
+        if ch is not None:
+            np.copyto(layer.ch[y0:y1, x0:x1], ch, where=where)
+        np.copyto(layer.mask[y0:y1, x0:x1], mask, where=where)
+        if journal is not None and not journal.open:
+            journal.end(self)
+        layer.touch(x0, y0, x1, y1)
+        if len(self.layers) > 1 or self.sync is not None:
+            ys, xs = np.nonzero(where)
+            index = ((ys + y0) * self.w + xs + x0).astype("u4")
+            self.composite(index)
+            if self.sync is not None:
+                self.sync.send(self, index)
+        self.invalidate_cells(x0, y0, x1, y1)
+
+    def erase_cells(self, index):
+        # Erased cells are blank, on any layer but the bottom one the layers below show through again
+        self.write_cells(index, (0, 0, 0), (0, 0, 0), 32, mask=self.active == 0)
+
+    def erase_rect(self, x0, y0, x1, y1):
+        self.write_rect(x0, y0, x1, y1, (0, 0, 0), (0, 0, 0), 32, mask=self.active == 0)
+
+    def set_pixel(self, x, y, fg, bg, s):
+        self.write_cells([y * self.w + x], None if s == " " else fg, bg, ord(s))
 
     def resize(self, factor):
         # Smallest zoom distance is 1x2, so we don't lose the actual pixel ratio
-        self.px = round(self.px * factor) if round(self.px * factor) >= 1 else 1
+        self.px = min(self.max_px, max(1, round(self.px * factor)))
         if self.px * 0.8 < self.font.size(" ")[0] < self.px * 1.2:
             self.px = self.font.size(" ")[0]
-        self.redraw()
 
-    def save_to_file(self, path):
+    def encode(self, minimal=False, planes=None, palette=None, dither=False):
+        # Flattened (fg, bg, ch) planes of a frame, by default the visible ones of the current frame.
+        # Colors are 24 bit unless palette names one of colors.PALETTES
+        fg, bg, ch = (self.fg, self.bg, self.ch) if planes is None else planes
+        n = self.w * self.h
+        ch = np.where(ch < 32, 32, ch).ravel()
+        text = ch.astype("<u4").tobytes().decode("utf-32-le")
+        fg, bg = color_codes(fg, palette, dither).ravel(), color_codes(bg, palette, dither).ravel()
+        fg_code, bg_code = _CODES[palette]
+        if minimal:
+            # Nobody sees the foreground of a space, so spaces keep the last visible one and don't start a run
+            keep = ch != 32
+            keep[0] = True
+            fg = fg[np.maximum.accumulate(np.where(keep, np.arange(n), 0))]
+
+        # One color code per run, runs start wherever fg or bg differs from the cell before
+        fg_change = np.ones(n, dtype=bool)
+        fg_change[1:] = fg[1:] != fg[:-1]
+        bg_change = np.ones(n, dtype=bool)
+        bg_change[1:] = bg[1:] != bg[:-1]
+        start = fg_change | bg_change
+        start[::self.w] = True
+        starts = np.flatnonzero(start)
+        ends = np.append(starts[1:], n)
+
+        # Put together column by column, one row of pieces per run: bg code, fg code, text and the row end
+        bgs, fgs = _sgr(bg[starts], bg_code), _sgr(fg[starts], fg_code)
+        pieces = np.full((len(starts), 4), "", dtype=object)
+        pieces[bg_change[starts], 0] = bgs[bg_change[starts]]
+        pieces[fg_change[starts], 1] = fgs[fg_change[starts]]
+        pieces[:, 2] = [text[a:b] for a, b in zip(starts.tolist(), ends.tolist())]
+        row_end = ends % self.w == 0
+        # Minimal output lets the colors carry over into the next row
+        pieces[row_end, 3] = "\n" if minimal else "\x1b[0m\n" + bgs[row_end] + _sgr(fg[ends[row_end] - 1], fg_code)
+        return "".join(pieces.ravel().tolist())
+
+    def encode_delta(self, old, new, palette=None, dither=False):
+        # Only the cells of new that differ from old, every run of them placed with a cursor position
+        changed = np.zeros(self.w * self.h, dtype=bool)
+        for a, b in zip(old, new):
+            changed |= (a != b).reshape(self.w * self.h, -1).any(axis=1)
+        index = np.flatnonzero(changed)
+        if len(index) == 0:
+            return ""
+        ch = np.where(new[2] < 32, 32, new[2]).ravel()[index]
+        text = ch.astype("<u4").tobytes().decode("utf-32-le")
+        fg = color_codes(new[0], palette, dither).ravel()[index]
+        bg = color_codes(new[1], palette, dither).ravel()[index]
+        fg_code, bg_code = _CODES[palette]
+        keep = ch != 32
+        keep[0] = True
+        fg = fg[np.maximum.accumulate(np.where(keep, np.arange(len(index)), 0))]
+
+        # A run is cut wherever a cell is skipped or a row begins, colors only where they change
+        jump = np.ones(len(index), dtype=bool)
+        jump[1:] = (index[1:] != index[:-1] + 1) | (index[1:] % self.w == 0)
+        fg_change = np.ones(len(index), dtype=bool)
+        fg_change[1:] = fg[1:] != fg[:-1]
+        bg_change = np.ones(len(index), dtype=bool)
+        bg_change[1:] = bg[1:] != bg[:-1]
+        starts = np.flatnonzero(jump | fg_change | bg_change)
+        ends = np.append(starts[1:], len(index))
+
+        out = []
+        for a, b, cell, jmp, fgc, bgc, fgv, bgv in zip(starts.tolist(), ends.tolist(), index[starts].tolist(),
+                                                         jump[starts].tolist(), fg_change[starts].tolist(),
+                                                         bg_change[starts].tolist(), fg[starts].tolist(),
+                                                         bg[starts].tolist()):
+            if jmp:
+                # Always with both numbers, a bare cursor home marks the start of a frame
+                out.append(f"\x1b[{cell // self.w + 1};{cell % self.w + 1}H")
+            if bgc:
+                out.append(bg_code(bgv))
+            if fgc:
+                out.append(fg_code(fgv))
+            out.append(text[a:b])
+        return "".join(out)
+
+    def encode_frames(self, minimal=False, loop=False, palette=None, dither=False):
+        # The first frame in full, every other one as cursor home and the changes to the frame before.
+        # With loop, one more delta leads from the last frame back to the first
+        planes = [flatten(layers) for layers in self.frames]
+        out = [self.encode(minimal, planes[0], palette, dither)]
+        if loop and len(planes) > 1:
+            planes.append(planes[0])
+        for old, new in zip(planes, planes[1:]):
+            out.append("\x1b[H" + self.encode_delta(old, new, palette, dither))
+        return out
+
+    def save_to_file(self, path, minimal=False, progress=None, palette=None, dither=False):
+        text = "".join(self.encode_frames(minimal, palette=palette, dither=dither))
         with open(path, "w", encoding="utf-8") as ofile:
-            last_fg = ""
-            last_bg = ""
-            for n in range(self.w * self.h):
-                s = " " if str(self.s[n]) == "" else str(self.s[n])
-                fg = f"\x1b[38;2;{self.fg_r[n]};{self.fg_g[n]};{self.fg_b[n]}m"
-                bg = f"\x1b[48;2;{self.bg_r[n]};{self.bg_g[n]};{self.bg_b[n]}m"
-                if fg != last_fg:
-                    s = fg + s
-                if bg != last_bg:
-                    s = bg + s
-                if (n + 1) % self.w == 0:
-                    s += "\x1b[0m\n" + bg + fg
-                ofile.write(s)
-                last_fg = fg
-                last_bg = bg
-
-
-def load_image_from_file(path, font) -> Image:
-    with open(path, "r", encoding="utf-8") as ifile:
-        data = dict()
-        w = -1
-        index = 0
-        row = 0
-        char = ifile.read(1)
-        last_bg = (0, 0, 0)
-        last_fg = (0, 0, 0)
-        while char != "":
-            if char == "\n":
-                row += 1
-                if w < 0:
-                    w = index
-                char = ifile.read(1)
-                continue
-            # FG r g b, BG r g b, s
-            if index not in data:
-                bgr, bgg, bgb = last_bg
-                fgr, fgg, fgb = last_fg
-                data[index] = [fgr, fgg, fgb, bgr, bgg, bgb, ""]
-            if char == "\x1b":
-                tag = ""
-                while char != "m":
-                    tag += char
-                    char = ifile.read(1)
-                spl = list(map(int, tag[2:].split(";")))
-                if spl[0] == 38:
-                    data[index][0] = spl[2]
-                    data[index][1] = spl[3]
-                    data[index][2] = spl[4]
-                    last_fg = (spl[2], spl[3], spl[4])
-                elif spl[0] == 48:
-                    data[index][3] = spl[2]
-                    data[index][4] = spl[3]
-                    data[index][5] = spl[4]
-                    last_bg = (spl[2], spl[3], spl[4])
+            # In pieces, so whoever waits hears about it
+            for start in range(0, len(text), 1 << 20):
+                ofile.write(text[start:start + (1 << 20)])
+                if progress is not None:
+                    progress(min(1.0, (start + (1 << 20)) / len(text)))
+
+
+def flatten(layers, out=None):
+    # Visible cells of a layer stack, the topmost visible layer covering a cell wins. Fills the planes of out,
+    # without out a single layer is returned as it is and anything else in new planes
+    base = layers[0]
+    if out is None:
+        if len(layers) == 1:
+            return base.fg, base.bg, base.ch
+        out = np.empty_like(base.fg), np.empty_like(base.bg), np.empty_like(base.ch)
+    fg, bg, ch = out
+    if base.visible:
+        np.copyto(fg, base.fg)
+        np.copyto(bg, base.bg)
+        np.copyto(ch, base.ch)
+    else:
+        fg[...], bg[...], ch[...] = 0, 0, 32
+    for layer in layers[1:]:
+        if layer.visible:
+            np.copyto(fg, layer.fg, where=layer.mask[..., None])
+            np.copyto(bg, layer.bg, where=layer.mask[..., None])
+            np.copyto(ch, layer.ch, where=layer.mask)
+    return out
+
+
+def _fg_code(c):
+    return f"\x1b[38;2;{c >> 16};{(c >> 8) & 255};{c & 255}m"
+
+
+def _bg_code(c):
+    return f"\x1b[48;2;{c >> 16};{(c >> 8) & 255};{c & 255}m"
+
+
+# Palette codes are looked up rather than formatted, dithered output has a lot of them
+_FG_256 = [f"\x1b[38;5;{c}m" for c in range(256)]
+_BG_256 = [f"\x1b[48;5;{c}m" for c in range(256)]
+_FG_16 = [f"\x1b[{30 + c if c < 8 else 82 + c}m" for c in range(16)]
+_BG_16 = [f"\x1b[{40 + c if c < 8 else 92 + c}m" for c in range(16)]
+# SGR codes for the colors of each palette, None for 24 bit
+_CODES = {None: (_fg_code, _bg_code), "256": (_FG_256.__getitem__, _BG_256.__getitem__),
+          "16": (_FG_16.__getitem__, _BG_16.__getitem__)}
+
+
+def _sgr(values, code):
+    # Escape sequences of many color values as an object array, each distinct value formatted once
+    unique, inverse = np.unique(values, return_inverse=True)
+    return np.array([code(v) for v in unique.tolist()] + [None], dtype=object)[:-1][inverse]
+
+
+def pack_colors(rgb):
+    # (..., 3) uint8 colors as single 24 bit integers
+    return (rgb[..., 0].astype("u4") << 16) | (rgb[..., 1].astype("u4") << 8) | rgb[..., 2]
+
+
+def color_codes(rgb, palette=None, dither=False):
+    # What goes into the SGR codes of (h, w, 3) colors: 24 bit integers, or the nearest entries of palette
+    return pack_colors(rgb) if palette is None else quantize(rgb, palette, dither)
+
+
+# Escape sequences, line breaks and runs of printable text
+_TOKENS = re.compile(r"\x1b\[([0-9;]*)([@-~])|(\n)|([^\x1b\r\n]+)|[\x1b\r]")
+_PARTIAL = re.compile(r"\x1b(\[[0-9;]*)?")
+
+
+# Marks what an SGR sequence leaves as it is
+_KEEP = object()
+# Parsed effect of every SGR parameter string seen so far, art repeats the same few codes over and over
+_SGR_EFFECTS = dict()
+
+
+def _sgr_effect(params):
+    # Whether the sequence resets first, then the fg with its base color, bg and bold it ends up setting
+    reset, fg, base, bg, bold = False, _KEEP, None, _KEEP, _KEEP
+    codes = [int(p) if p else 0 for p in params.split(";")]
+    i = 0
+    while i < len(codes):
+        c = codes[i]
+        if c == 0:
+            reset, fg, base, bg, bold = True, _KEEP, None, _KEEP, _KEEP
+        elif c == 1:
+            bold = True
+        elif c == 22:
+            bold = False
+        elif c in (38, 48) and i + 2 < len(codes) and codes[i + 1] == 5:
+            color = tuple(int(v) for v in XTERM_256[codes[i + 2] % 256])
+            if c == 38:
+                fg, base = color, None
             else:
-                data[index][6] = char
-                index += 1
-            char = ifile.read(1)
-        img = Image(w, row, font)
-        for n, key in enumerate(data):
-            entry = data[key]
-            img.fg_r[n] = entry[0]
-            img.fg_g[n] = entry[1]
-            img.fg_b[n] = entry[2]
-            img.bg_r[n] = entry[3]
-            img.bg_g[n] = entry[4]
-            img.bg_b[n] = entry[5]
-            img.s[n] = entry[6]
-        img.redraw()
-        return img
+                bg = color
+            i += 2
+        elif c in (38, 48) and i + 4 < len(codes) and codes[i + 1] == 2:
+            color = tuple(v % 256 for v in codes[i + 2:i + 5])
+            if c == 38:
+                fg, base = color, None
+            else:
+                bg = color
+            i += 4
+        elif 30 <= c <= 37 or 90 <= c <= 97:
+            base = c - 30 if c < 90 else c - 82
+            fg = tuple(int(v) for v in VGA_16[base])
+        elif 40 <= c <= 47 or 100 <= c <= 107:
+            bg = tuple(int(v) for v in VGA_16[c - 40 if c < 100 else c - 92])
+        elif c == 39:
+            fg, base = DEFAULT_FG, None
+        elif c == 49:
+            bg = DEFAULT_BG
+        i += 1
+    return reset, fg, base, bg, bold
+
+
+def _apply_sgr(params, fg, bg, bold, base):
+    effect = _SGR_EFFECTS.get(params)
+    if effect is None:
+        if len(_SGR_EFFECTS) > 65536:
+            _SGR_EFFECTS.clear()
+        effect = _SGR_EFFECTS[params] = _sgr_effect(params)
+    reset, new_fg, new_base, new_bg, new_bold = effect
+    if reset:
+        fg, bg, bold, base = DEFAULT_FG, DEFAULT_BG, False, None
+    if new_fg is not _KEEP:
+        fg, base = new_fg, new_base
+    if new_bg is not _KEEP:
+        bg = new_bg
+    if new_bold is not _KEEP:
+        bold = new_bold
+    # Bold turns the eight basic foreground colors into their bright variants
+    if bold and base is not None and base < 8:
+        fg = _BRIGHT[base]
+    return fg, bg, bold, base
+
+
+_BRIGHT = [tuple(int(v) for v in VGA_16[base + 8]) for base in range(8)]
+
+
+def load_image_from_file(path, font, chunk_size=1 << 20, progress=None) -> Image:
+    # Cell planes, grown by doubling while reading
+    fgs, bgs, chs = np.zeros((4096, 3), dtype="u1"), np.zeros((4096, 3), dtype="u1"), np.full(4096, 32, dtype="u4")
+
+    def reserve(n):
+        old = len(chs)
+        if n > old:
+            size = max(n, 2 * old)
+            fgs.resize((size, 3), refcheck=False)
+            bgs.resize((size, 3), refcheck=False)
+            chs.resize(size, refcheck=False)
+            chs[old:] = 32
+
+    def finish(n):
+        reserve(n)
+        fgs.resize((n, 3), refcheck=False)
+        bgs.resize((n, 3), refcheck=False)
+        chs.resize(n, refcheck=False)
+        return fgs, bgs, chs
+
+    # Animations start every frame after the first with a bare cursor home, frames holds the finished ones
+    frames = []
+    w, h, row, col = -1, -1, 0, 0
+    fg, bg, bold, base = DEFAULT_FG, DEFAULT_BG, False, None
+    with open(path, "r", encoding="utf-8") as ifile:
+        rest = ""
+        while True:
+            chunk = ifile.read(chunk_size)
+            data = rest + chunk
+            rest = ""
+            if chunk:
+                # An escape sequence cut in half by the chunk boundary waits for the next chunk
+                tail = data.rfind("\x1b")
+                if tail >= 0 and _PARTIAL.fullmatch(data, tail):
+                    data, rest = data[:tail], data[tail:]
+            for match in _TOKENS.finditer(data):
+                params, command, newline, text = match.groups()
+                if text is not None:
+                    pos = 0
+                    while pos < len(text):
+                        if 0 < w <= col:
+                            row, col = row + 1, 0
+                        n = len(text) - pos if w < 0 else min(len(text) - pos, w - col)
+                        i = row * max(w, 0) + col
+                        reserve(i + n)
+                        fgs[i:i + n] = fg
+                        bgs[i:i + n] = bg
+                        if n == 1:
+                            # Colors change every cell or two in a lot of art
+                            chs[i] = ord(text[pos])
+                        else:
+                            chs[i:i + n] = np.frombuffer(text[pos:pos + n].encode("utf-32-le"), dtype="<u4")
+                        col += n
+                        pos += n
+                elif newline is not None:
+                    if w < 0:
+                        w = col
+                    row, col = row + 1, 0
+                elif command == "m":
+                    fg, bg, bold, base = _apply_sgr(params, fg, bg, bold, base)
+                elif command == "C":
+                    # Cursor forward, skipped cells stay empty
+                    col += int(params or 1)
+                    if w > 0:
+                        col = min(col, w - 1)
+                elif command == "H" and not params and (frames or row > 0 or col > 0):
+                    if w < 0:
+                        w = col
+                    if not frames:
+                        h = row + 1 if col > 0 else row
+                    # The next frame is drawn over a copy of the last one
+                    frames.append(finish(w * h))
+                    fgs, bgs, chs = fgs.copy(), bgs.copy(), chs.copy()
+                    row, col = 0, 0
+                elif command in ("H", "f"):
+                    # Cursor position, 1-based row;column
+                    r, _, c = params.partition(";")
+                    row, col = max(int(r or 1) - 1, 0), max(int(c or 1) - 1, 0)
+                    if w > 0:
+                        col = min(col, w - 1)
+            if not chunk:
+                break
+            if progress is not None:
+                progress(min(1.0, ifile.buffer.tell() / max(1, os.fstat(ifile.fileno()).st_size)))
+    if w < 0:
+        w = col
+    if not frames:
+        h = row + 1 if col > 0 else row
+    if w <= 0 or h <= 0:
+        raise IOError(f"No image data in '{path}'")
+    frames.append(finish(w * h))
+    img = Image(w, h, font)
+    for n, (fgs, bgs, chs) in enumerate(frames):
+        if n > 0:
+            img.add_frame()
+        img.fg[...], img.bg[...], img.ch[...] = fgs.reshape(h, w, 3), bgs.reshape(h, w, 3), chs.reshape(h, w)
+    img.select_frame(0)
+    return img
@@ -0,0 +1,203 @@
+"""
+ansi.e -  A simple ANSI art editor.
+Copyright (C) 2024 Dominik Behrens
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the Lesser GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import struct
+import numpy as np
+
+from ansidote.image import Image, Layer, flatten
+
+# Working files: a header, a table of layers and their raw planes, opened as memory maps.
+# .ans stays the format for everything that leaves the studio
+NATIVE_EXTENSION = ".ansb"
+MAGIC = b"ANSB"
+VERSION = 1
+# Magic, version, flags, width, height, number of frames, then the number of layers of each frame as u4
+HEADER = struct.Struct("<4sHHIII")
+# Visibility and utf-8 name of every layer, frame by frame from the bottom up
+LAYER = struct.Struct("<B63s")
+
+
+def layout(image):
+    return image.w, image.h, tuple(len(layers) for layers in image.frames)
+
+
+def _data_offset(frames):
+    size = HEADER.size + 4 * len(frames) + LAYER.size * sum(frames)
+    return (size + 63) // 64 * 64
+
+
+def _block_size(w, h):
+    # One layer: code points first so they stay aligned, then fg, bg and the mask, padded to 8 bytes
+    return (11 * w * h + 7) // 8 * 8
+
+
+def _planes(w, h):
+    # (name, offset in the block, bytes per row) of every plane of a layer
+    n = w * h
+    return ("ch", 0, 4 * w), ("fg", 4 * n, 3 * w), ("bg", 7 * n, 3 * w), ("mask", 10 * n, w)
+
+
+def _header(image):
+    layers = [layer for frame in image.frames for layer in frame]
+    out = [HEADER.pack(MAGIC, VERSION, 0, image.w, image.h, len(image.frames)),
+           struct.pack(f"<{len(image.frames)}I", *(len(frame) for frame in image.frames))]
+    out += [LAYER.pack(layer.visible, layer.name.encode("utf-8")[:63]) for layer in layers]
+    data = b"".join(out)
+    return data + bytes(_data_offset(layout(image)[2]) - len(data))
+
+
+def _map_planes(data, frames, n, w, h):
+    # (fg, bg, ch, mask) of layer n as views of the mapped file data
+    base = _data_offset(frames) + n * _block_size(w, h)
+    planes = dict()
+    for plane, offset, row in _planes(w, h):
+        planes[plane] = data[base + offset:base + offset + row * h]
+    return (planes["fg"].reshape(h, w, 3), planes["bg"].reshape(h, w, 3),
+            planes["ch"].view("<u4").reshape(h, w), planes["mask"].view(bool).reshape(h, w))
+
+
+def _swap_planes(image, layer, planes):
+    layer.fg, layer.bg, layer.ch, layer.mask = planes
+    # A single layer shares its planes with the image
+    if len(image.layers) == 1 and image.layers[0] is layer:
+        image.fg, image.bg, image.ch = flatten(image.layers)
+
+
+def snapshot_native(image, path, since=None, copy=True):
+    # Copies of what saving image to path writes, so painting can go on while it is written. since is what
+    # an earlier save to the same file returned, then only the rows written after it are copied.
+    # Without copy, a full write reads the layers while it is written: rows painted meanwhile may be saved
+    # half done, but they count as written after this snapshot and go out again with the next save
+    w, h, frames = layout(image)
+    layers = [layer for frame in image.frames for layer in frame]
+    target = os.path.abspath(path)
+    done = (target, layout(image), tuple(layer.uid for layer in layers), tuple(layer.version for layer in layers))
+    if since is not None and since[:3] == done[:3] and os.path.exists(target):
+        writes = []
+        for n, layer in enumerate(layers):
+            base = _data_offset(frames) + n * _block_size(w, h)
+            edges = np.diff(np.concatenate(([0], (layer.rows > since[3][n]).view("i1"), [0])))
+            for y0, y1 in zip(np.flatnonzero(edges == 1).tolist(), np.flatnonzero(edges == -1).tolist()):
+                for name, offset, row in _planes(w, h):
+                    data = np.ascontiguousarray(getattr(layer, name)[y0:y1]).tobytes()
+                    writes.append((base + offset + y0 * row, data))
+        return done, _header(image), writes, False
+    # The file is replaced, which some systems refuse while it is mapped: layers read from it are moved into
+    # memory first, remap_native reads them from the new file once it is written
+    for layer in layers:
+        if getattr(layer.ch, "filename", None) == target:
+            _swap_planes(image, layer, tuple(np.array(getattr(layer, name)) for name in ("fg", "bg", "ch", "mask")))
+    if not copy:
+        return done, _header(image), layers, True
+    blocks = []
+    for layer in layers:
+        block = b"".join(np.ascontiguousarray(getattr(layer, name)).tobytes() for name, _, _ in _planes(w, h))
+        blocks.append(block + bytes(_block_size(w, h) - len(block)))
+    return done, _header(image), blocks, True
+
+
+def _write_layer(f, layer, w, h, rows=256):
+    # A few rows at a time, nothing the size of the canvas is held in memory
+    for name, _, _ in _planes(w, h):
+        plane = getattr(layer, name)
+        for y in range(0, h, rows):
+            f.write(np.ascontiguousarray(plane[y:y + rows]).tobytes())
+    f.write(bytes(_block_size(w, h) - 11 * w * h))
+
+
+def write_native(snapshot, progress=None):
+    # Returns what the file now holds, pass it as since to save there again
+    done, header, parts, full = snapshot
+    target = done[0]
+    if full:
+        # Written next to the target first, a memory map of the old file stays valid
+        tmp = target + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(header)
+            for n, block in enumerate(parts):
+                if isinstance(block, Layer):
+                    _write_layer(f, block, *done[1][:2])
+                else:
+                    f.write(block)
+                if progress is not None:
+                    progress((n + 1) / len(parts))
+        os.replace(tmp, target)
+    else:
+        with open(target, "r+b") as f:
+            f.write(header)
+            for n, (offset, data) in enumerate(parts):
+                f.seek(offset)
+                f.write(data)
+                if progress is not None and n % 256 == 255:
+                    progress((n + 1) / len(parts))
+    return done
+
+
+def remap_native(image, done):
+    # Once done is written, called on the thread that edits image: layers unchanged since are read from the
+    # file from then on, like when it is opened, instead of being held in memory
+    w, h, frames = done[1]
+    layers = [layer for frame in image.frames for layer in frame]
+    if layout(image) != done[1] or tuple(layer.uid for layer in layers) != done[2]:
+        return
+    data = None
+    for n, layer in enumerate(layers):
+        if layer.version != done[3][n] or getattr(layer.ch, "filename", None) is not None:
+            continue
+        if data is None:
+            data = np.memmap(done[0], dtype="u1", mode="c")
+        _swap_planes(image, layer, _map_planes(data, frames, n, w, h))
+
+
+def save_native(image, path):
+    # Files this image was opened from or saved to before only get the rows written since then
+    image.native = write_native(snapshot_native(image, path, image.native))
+    remap_native(image, image.native)
+
+
+def load_native(path, font):
+    with open(path, "rb") as f:
+        try:
+            magic, version, _, w, h, count = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise IOError
+            frames = struct.unpack(f"<{count}I", f.read(4 * count))
+            table = [LAYER.unpack(f.read(LAYER.size)) for _ in range(sum(frames))]
+        except (IOError, struct.error):
+            # Cut short or not ours at all
+            raise IOError(f"'{path}' is not an ansidote canvas")
+    if w == 0 or h == 0 or not frames or 0 in frames:
+        raise IOError(f"No image data in '{path}'")
+
+    # Copy on write: edits stay in memory until saved, untouched cells are only read from disk when needed
+    data = np.memmap(path, dtype="u1", mode="c")
+    if len(data) < _data_offset(frames) + len(table) * _block_size(w, h):
+        raise IOError(f"'{path}' is cut short")
+    layers = []
+    for n, (visible, name) in enumerate(table):
+        layer = Layer(w, h, name.rstrip(b"\0").decode("utf-8", "replace"), planes=_map_planes(data, frames, n, w, h))
+        layer.visible = bool(visible)
+        layers.append(layer)
+    stacks, start = [], 0
+    for n in frames:
+        stacks.append(layers[start:start + n])
+        start += n
+    image = Image(w, h, font, frames=stacks)
+    image.native = (os.path.abspath(path), layout(image), tuple(layer.uid for layer in layers),
+                    tuple(layer.version for layer in layers))
+    return image
@@ -0,0 +1,90 @@
+"""
+ansi.e -  A simple ANSI art editor.
+Copyright (C) 2024 Dominik Behrens
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the Lesser GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import json
+import time
+import numpy as np
+
+from collections import deque
+from contextlib import nullcontext
+
+_NULL = nullcontext()
+
+
+class _Span:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        if self.profiler.trace is not None:
+            self.profiler.trace.append((self.name, self.start, time.perf_counter()))
+
+
+class FrameProfiler:
+    def __init__(self, frames=240):
+        # Rolling frame times for the overlay, spans are only kept while a trace is recorded
+        self.overlay = False
+        self.trace = None
+        self.times = deque(maxlen=frames)
+        self.frame_start = None
+        self.origin = time.perf_counter()
+
+    @property
+    def enabled(self):
+        return self.overlay or self.trace is not None
+
+    def span(self, name):
+        if not self.enabled:
+            return _NULL
+        return _Span(self, name)
+
+    def begin_frame(self):
+        if self.enabled:
+            self.frame_start = time.perf_counter()
+
+    def end_frame(self):
+        if self.frame_start is None:
+            return
+        end = time.perf_counter()
+        self.times.append(end - self.frame_start)
+        if self.trace is not None:
+            self.trace.append(("frame", self.frame_start, end))
+        self.frame_start = None
+
+    def percentiles(self):
+        if not self.times:
+            return 0.0, 0.0
+        p50, p99 = np.percentile(np.array(self.times), [50, 99])
+        return p50 * 1000, p99 * 1000
+
+    def start_trace(self):
+        self.trace = list()
+
+    def stop_trace(self, path):
+        # Chrome trace event format, opens in chrome://tracing or Perfetto
+        events = [{"name": name, "ph": "X", "pid": 1, "tid": 1, "ts": (start - self.origin) * 1e6,
+                   "dur": (end - start) * 1e6} for name, start, end in self.trace]
+        self.trace = None
+        with open(path, "w") as ofile:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, ofile)
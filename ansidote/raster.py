@@ -0,0 +1,75 @@
+"""
+ansi.e -  A simple ANSI art editor.
+Copyright (C) 2024 Dominik Behrens
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the Lesser GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import pygame
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from ansidote.image import Image
+
+RASTER_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tga", ".webp")
+
+# Bigger inputs than this are converted in row bands by a process pool
+BAND_PIXELS = 16 * 1024 * 1024
+
+
+def _convert_band(pixels, row_edges, col_edges):
+    # Average every block of source pixels into one half cell, two half cells make up a cell
+    sums = np.add.reduceat(np.add.reduceat(pixels.astype("u8"), row_edges[:-1], axis=0), col_edges[:-1], axis=1)
+    counts = np.outer(np.diff(row_edges), np.diff(col_edges))[..., None]
+    halves = ((sums + counts // 2) // counts).astype("u1")
+    top, bottom = halves[0::2], halves[1::2]
+
+    # The lighter half is drawn as the glyph, so backgrounds stay dark and form long runs
+    weights = np.array([299, 587, 114])
+    top_light = top @ weights >= bottom @ weights
+    same = (top == bottom).all(axis=-1)
+    ch = np.where(same, ord("█"), np.where(top_light, ord("▀"), ord("▄"))).astype("u4")
+    fg = np.where(top_light[..., None], top, bottom)
+    bg = np.where(top_light[..., None], bottom, top)
+    return fg, bg, ch
+
+
+def load_image_from_raster(path, font, columns=None, jobs=None) -> Image:
+    pixels = pygame.surfarray.array3d(pygame.image.load(path)).transpose(1, 0, 2)
+    if pixels.shape[0] < 2:
+        pixels = np.repeat(pixels, 2, axis=0)
+    src_h, src_w = pixels.shape[:2]
+
+    # Cells are about twice as high as wide, so each one covers two square-ish pixels
+    w = src_w if columns is None else max(1, min(columns, src_w))
+    h = max(1, min(src_h // 2, round(src_h * w / src_w / 2)))
+    col_edges = np.linspace(0, src_w, w + 1).astype(int)
+    row_edges = np.linspace(0, src_h, 2 * h + 1).astype(int)
+
+    img = Image(w, h, font)
+    jobs = os.cpu_count() if jobs is None else jobs
+    if pixels.shape[0] * pixels.shape[1] <= BAND_PIXELS or jobs <= 1 or h < 2:
+        img.fg[...], img.bg[...], img.ch[...] = _convert_band(pixels, row_edges, col_edges)
+        return img
+
+    bands = np.array_split(np.arange(h), min(jobs, h))
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = []
+        for band in bands:
+            r0, r1 = 2 * band[0], 2 * (band[-1] + 1)
+            edges = row_edges[r0:r1 + 1]
+            futures.append(pool.submit(_convert_band, pixels[edges[0]:edges[-1]], edges - edges[0], col_edges))
+        for band, future in zip(bands, futures):
+            img.fg[band[0]:band[-1] + 1], img.bg[band[0]:band[-1] + 1], img.ch[band[0]:band[-1] + 1] = future.result()
+    return img
@@ -17,16 +17,24 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 import pygame
 
+from functools import lru_cache
 from importlib.resources import files
 
-icon_open = pygame.image.frombytes(
-    files('ansidote.resources').joinpath('open.bin').read_bytes(), (32, 32), 'RGBA'
-)
-icon_settings = pygame.image.frombytes(
-    files('ansidote.resources').joinpath('settings.bin').read_bytes(), (32, 32), 'RGBA'
-)
-icon_save = pygame.image.frombytes(
-    files('ansidote.resources').joinpath('save.bin').read_bytes(), (32, 32), 'RGBA'
-)
-
-__all__ = [icon_open, icon_settings, icon_save]
+# Icons are decoded when first used, not when the package is imported
+ICONS = {"icon_open": "open.bin", "icon_settings": "settings.bin", "icon_save": "save.bin"}
+
+
+@lru_cache(maxsize=None)
+def load_icon(name):
+    return pygame.image.frombytes(
+        files('ansidote.resources').joinpath(ICONS[name]).read_bytes(), (32, 32), 'RGBA'
+    )
+
+
+def __getattr__(name):
+    if name in ICONS:
+        return load_icon(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+__all__ = ["icon_open", "icon_settings", "icon_save"]
@@ -0,0 +1,173 @@
+"""
+ansi.e -  A simple ANSI art editor.
+Copyright (C) 2024 Dominik Behrens
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the Lesser GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import numpy as np
+
+from bisect import bisect_right
+
+
+def line_cells(x0, y0, x1, y1):
+    # Every cell on the line between two cells, no gaps in either direction
+    n = max(abs(x1 - x0), abs(y1 - y0)) + 1
+    xs = np.rint(np.linspace(x0, x1, n)).astype(int)
+    ys = np.rint(np.linspace(y0, y1, n)).astype(int)
+    return xs, ys
+
+
+class Stroke:
+    def __init__(self):
+        self.last = None
+        self.xs = list()
+        self.ys = list()
+
+    def move(self, cell):
+        x, y = cell
+        if self.last is None:
+            xs, ys = np.array([x]), np.array([y])
+        else:
+            xs, ys = line_cells(*self.last, x, y)
+        self.xs.append(xs)
+        self.ys.append(ys)
+        self.last = cell
+
+    def lift(self):
+        # The next move starts a new line instead of connecting to the last cell
+        self.last = None
+
+    def flush(self, image, fg, bg, s, erase=False):
+        # Everything covered since the last flush in one write, returns the bounding box of the written cells
+        if not self.xs:
+            return None
+        xs, ys = np.concatenate(self.xs), np.concatenate(self.ys)
+        self.xs.clear()
+        self.ys.clear()
+        inside = (xs >= 0) & (xs < image.w) & (ys >= 0) & (ys < image.h)
+        xs, ys = xs[inside], ys[inside]
+        if len(xs) == 0:
+            return None
+        if erase:
+            image.erase_cells(np.unique(ys * image.w + xs))
+        else:
+            image.write_cells(np.unique(ys * image.w + xs), None if s == " " else fg, bg, ord(s))
+        return int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1
+
+
+def match_mask(image, x, y, tolerance=0):
+    # Cells with the same character and colors within tolerance of the cell at x, y
+    def close(plane):
+        mask = np.ones(plane.shape[:2], dtype=bool)
+        for c in range(3):
+            if tolerance == 0:
+                mask &= plane[..., c] == plane[y, x, c]
+            else:
+                mask &= np.abs(plane[..., c].astype("i2") - plane[y, x, c]) <= tolerance
+        return mask
+
+    mask = image.ch == image.ch[y, x]
+    mask &= close(image.bg)
+    if image.ch[y, x] > 32:
+        # The foreground only matters where there is a glyph to see it
+        mask &= close(image.fg)
+    return mask
+
+
+def flood_mask(image, x, y, tolerance=0):
+    mask = match_mask(image, x, y, tolerance)
+    h, w = mask.shape
+
+    # All horizontal runs of matching cells, in row order: run i covers [starts[i], ends[i]) of row rows[i]
+    padded = np.zeros((h, w + 2), dtype="i1")
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    ends = np.nonzero(edges == -1)[1]
+    first = np.searchsorted(rows, np.arange(h + 1)).tolist()
+    starts_list, ends_list = starts.tolist(), ends.tolist()
+
+    # Scanline fill over whole runs, runs overlapping it in the rows above and below are visited next
+    seed = bisect_right(starts_list, x, first[y], first[y + 1]) - 1
+    visited = bytearray(len(starts_list))
+    visited[seed] = 1
+    stack = [(seed, y)]
+    while stack:
+        run, y = stack.pop()
+        x0, x1 = starts_list[run], ends_list[run]
+        for ny in (y - 1, y + 1):
+            if 0 <= ny < h:
+                other = bisect_right(ends_list, x0, first[ny], first[ny + 1])
+                while other < first[ny + 1] and starts_list[other] < x1:
+                    if not visited[other]:
+                        visited[other] = 1
+                        stack.append((other, ny))
+                    other += 1
+
+    # Back to cells: +1 where a visited run starts, -1 where it ends, the running sum is the mask
+    hit = np.frombuffer(bytes(visited), dtype="u1").astype(bool)
+    marks = np.zeros((h, w + 1), dtype="i1")
+    marks[rows[hit], starts[hit]] = 1
+    marks[rows[hit], ends[hit]] = -1
+    return np.cumsum(marks, axis=1, dtype="i1")[:, :w] > 0
+
+
+def flood_fill(image, x, y, fg, bg, s, tolerance=0):
+    return image.write_masked(flood_mask(image, x, y, tolerance), None if s == " " else fg, bg, ord(s))
+
+
+def rect_fill(image, a, b, fg, bg, s):
+    # a and b are opposite corner cells, both included
+    x0, x1 = sorted((a[0], b[0]))
+    y0, y1 = sorted((a[1], b[1]))
+    image.write_rect(x0, y0, x1 + 1, y1 + 1, None if s == " " else fg, bg, ord(s))
+    return x0, y0, x1 + 1, y1 + 1
+
+
+def copy_rect(image, x0, y0, x1, y1):
+    # Cells [x0, x1) x [y0, y1) of the active layer as (fg, bg, ch, mask) blocks, copies so later edits don't
+    # show through
+    layer = image.layer
+    return tuple(plane[y0:y1, x0:x1].copy() for plane in (layer.fg, layer.bg, layer.ch, layer.mask))
+
+
+def cut_rect(image, x0, y0, x1, y1):
+    clip = copy_rect(image, x0, y0, x1, y1)
+    image.erase_rect(x0, y0, x1, y1)
+    return clip
+
+
+def paste(image, clip, x, y):
+    # The block with its top left corner at x, y, as far as it fits. Returns the box written or None
+    fg, bg, ch, mask = clip
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + ch.shape[1], image.w), min(y + ch.shape[0], image.h)
+    if x0 >= x1 or y0 >= y1:
+        return None
+    rows, columns = slice(y0 - y, y1 - y), slice(x0 - x, x1 - x)
+    image.write_rect(x0, y0, x1, y1, fg[rows, columns], bg[rows, columns], ch[rows, columns],
+                     mask=mask[rows, columns])
+    return x0, y0, x1, y1
+
+
+def move_rect(image, box, dx, dy):
+    # Cut and paste in one undo step, returns the box the cells ended up in or None
+    x0, y0, x1, y1 = box
+    journal = image.journal
+    if journal is not None:
+        journal.begin()
+    moved = paste(image, cut_rect(image, x0, y0, x1, y1), x0 + dx, y0 + dy)
+    if journal is not None:
+        journal.end(image)
+    return moved
@@ -15,54 +15,137 @@ GNU Lesser General Public License for more details.
 You should have received a copy of the Lesser GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-import tkinter
 import pygame
 
-from tkinter.simpledialog import Dialog
+from collections import OrderedDict
+from ansidote.charset import CharacterIndex, load_blocks
 
 
 class CharacterMap:
-    def __init__(self, w, font: pygame.font.Font):
+    def __init__(self, w, font: pygame.font.Font, h=320):
         self.w = w
         self.surface = None
         self.font = font
         self.cols = int(w / font.size(" ")[1])
         self.sq = round(w / self.cols)
-        # Ugly hardcoded characters right now, load these externally later
-        self.chars = " ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
-        self.chars += "1234567890!§$%&/()=?`´+#-.,;:_'*²³{[]}\\~@<>|^°"
-        self.chars += "─━│┃┄┅┆┇┈┉┊┋┌┍┎┏┐┑┒┓└┕┖┗┘┙┚┛├┝┞┟┠┡┢┣┤┥┦┧┨┩┪┫┬┭┮┯┰┱┲┳┴┵" \
-                      "┶┷┸┹┺┻┼┽┾┿╀╁╂╃╄╅╆╇╈╉╊╋╌╍╎╏═║╒╓╔╕╖╗╘╙╚╛╜╝╞╟╠╡╢╣╤╥╦╧╨╩╪╫╬" \
-                      "╭╮╯╰╱╲╳╴╵╶╷╸╹╺╻╼╽╾╿▀▁▂▃▄▅▆▇█▉▊▋▌▍▎▐░▒▓▔▕▖▗▘▙▚▛▜▝▞▟"
-        self.h = int(len(self.chars) / self.cols) * self.sq + 5
-        if len(self.chars) % self.cols > 0:
-            self.h += self.sq
-        self.marker = (0, 0)
+        self.blocks = load_blocks()
+        self.all_chars = "".join(chars for _, chars in self.blocks)
+        # Built on the first search, indexing every name takes a moment
+        self.index = None
+        self.query = ""
+        self.chars = self.all_chars
+        # Only the rows from top on that fit into h are rendered, glyphs are kept for the ones scrolled back to
+        self.top = 0
+        self.glyphs = OrderedDict()
+        self.marker = 0
         self.selected = " "
+        # Bumped whenever the surface changes, so whoever shows it knows when to update
+        self.version = 0
+        self.resize(h)
+
+    def resize(self, h):
+        self.rows = max(1, int((h - 5) / self.sq))
+        self.h = self.rows * self.sq + 5
+        self.top = min(self.top, self.max_top())
         self.redraw()
 
+    def max_top(self):
+        return max(0, -(-len(self.chars) // self.cols) - self.rows)
+
+    def glyph(self, char):
+        srf = self.glyphs.get(char)
+        if srf is None:
+            srf = self.font.render(char, 1, (180, 180, 180))
+            self.glyphs[char] = srf
+            if len(self.glyphs) > 4096:
+                self.glyphs.popitem(last=False)
+        else:
+            self.glyphs.move_to_end(char)
+        return srf
+
+    def draw_cell(self, i):
+        row, col = divmod(i, self.cols)
+        if not self.top <= row < self.top + self.rows:
+            return
+        rect = pygame.Rect(col * self.sq, (row - self.top) * self.sq, self.sq, self.sq)
+        # Wide glyphs must not spill into the neighbours, they are not redrawn with this cell
+        self.surface.set_clip(rect)
+        self.surface.fill((30, 35, 40))
+        if i < len(self.chars):
+            self.surface.blit(self.glyph(self.chars[i]), (rect.x + .25 * self.sq, rect.y))
+        if i == self.marker:
+            pygame.draw.rect(self.surface, (0, 255, 0), rect, width=1)
+        self.surface.set_clip(None)
+
+    def draw_rows(self, first, last):
+        for row in range(first, last):
+            for i in range((self.top + row) * self.cols, (self.top + row + 1) * self.cols):
+                self.draw_cell(i)
+
     def redraw(self):
         self.surface = pygame.Surface((self.w, self.h))
         self.surface.fill((30, 35, 40))
-        x = 0
-        y = 0
-        for char in self.chars:
-            srf = self.font.render(f"{char} ", 1, (180, 180, 180))
-            if int(x) / self.sq == self.cols:
-                x = 0
-                y += self.sq
-            self.surface.blit(srf, (x + .25 * self.sq, y))
-            if (x / self.sq, y / self.sq) == self.marker:
-                pygame.draw.rect(self.surface, (0, 255, 0), (x, y, self.sq, self.sq), width=1)
-            x += self.sq
+        self.draw_rows(0, self.rows)
+        self.version += 1
+
+    def scroll(self, rows):
+        top = min(max(self.top + rows, 0), self.max_top())
+        moved, self.top = top - self.top, top
+        if moved == 0:
+            return False
+        self.version += 1
+        if abs(moved) >= self.rows:
+            self.draw_rows(0, self.rows)
+        else:
+            # Whatever is still visible moves along, only the rows that came into view are rendered
+            self.surface.scroll(0, -moved * self.sq)
+            if moved > 0:
+                self.draw_rows(self.rows - moved, self.rows)
+            else:
+                self.draw_rows(0, -moved)
+        return True
 
     def select(self, x, y):
-        try:
-            self.marker = (x, y)
-            self.selected = self.chars[y * self.cols + x]
-            self.redraw()
-        except IndexError:
-            pass
+        i = (self.top + y) * self.cols + x
+        if 0 <= x < self.cols and 0 <= i < len(self.chars):
+            old, self.marker = self.marker, i
+            self.selected = self.chars[i]
+            self.version += 1
+            if old is not None:
+                self.draw_cell(old)
+            self.draw_cell(i)
+
+    def choose(self, char):
+        # Select char by value, e.g. when picked from the image, and scroll it into view
+        old, i = self.marker, self.chars.find(char)
+        self.selected = char
+        self.version += 1
+        self.marker = i if i >= 0 else None
+        if old is not None:
+            self.draw_cell(old)
+        if self.marker is not None:
+            row = i // self.cols
+            if row < self.top:
+                self.scroll(row - self.top)
+            elif row >= self.top + self.rows:
+                self.scroll(row - self.top - self.rows + 1)
+            else:
+                self.draw_cell(i)
+
+    def search(self, query):
+        # Only show the characters whose name or block matches query, all of them if it is empty
+        self.query = query
+        if query.strip():
+            if self.index is None:
+                self.index = CharacterIndex(self.blocks)
+            self.chars = "".join(self.all_chars[i] for i in self.index.search(query))
+        else:
+            self.chars = self.all_chars
+        i = self.chars.find(self.selected)
+        self.marker = i if i >= 0 else None
+        self.top = 0 if self.marker is None else min(i // self.cols, self.max_top())
+        self.redraw()
+        return len(self.chars)
 
 
 class HistoryPalette:
@@ -71,6 +154,7 @@ class HistoryPalette:
         self.h = h
         self.history = list()
         self.surface = None
+        self.version = 0
         self.sq = int(self.w / 6)
         self.redraw()
 
@@ -91,6 +175,7 @@ class HistoryPalette:
             r, g, b = color
             pygame.draw.rect(self.surface, (r, g, b), (col * self.sq, row * self.sq, self.sq, self.sq))
             col += 1
+        self.version += 1
 
     def remember(self, color):
         if color not in self.history:
@@ -98,39 +183,3 @@ class HistoryPalette:
             if len(self.history) >= 12:
                 self.history = self.history[:12]
             self.redraw()
-
-
-class SettingsDialog(Dialog):
-    def __init__(self, w, h):
-        self.entry1, self.entry2 = None, None
-        self.w, self.h = w, h
-        super().__init__(None)
-
-    def body(self, master):
-        tkinter.Label(master, text="Canvas Width:").grid(row=0)
-        self.entry1 = tkinter.Entry(master)
-        self.entry1.insert(0, str(self.w))
-        self.entry1.grid(row=0, column=1)
-
-        tkinter.Label(master, text="Canvas Height:").grid(row=1)
-        self.entry2 = tkinter.Entry(master)
-        self.entry2.insert(0, str(self.h))
-        self.entry2.grid(row=1, column=1)
-        return self.entry1
-
-    def apply(self):
-        try:
-            self.w = int(self.entry1.get())
-            self.h = int(self.entry2.get())
-        except ValueError:
-            print("Invalid W/H")
-        super().apply()
-
-    def cancel(self, event: None = ...):
-        self.withdraw()
-        self.destroy()
-
-
-def open_settings_dialog(w, h):
-    d = SettingsDialog(w, h)
-    return d.w, d.h
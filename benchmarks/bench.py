@@ -0,0 +1,280 @@
+"""
+ansi.e -  A simple ANSI art editor.
+Copyright (C) 2024 Dominik Behrens
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the Lesser GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import numpy as np
+import pygame
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ansidote import collab
+from ansidote.fonts import load_font
+from ansidote.image import Image, load_image_from_file
+from ansidote.ui import CharacterMap
+
+SIZES = ["80x25", "400x200", "1000x500", "2000x1000"]
+VIEWPORT = (1600, 900)
+GLYPHS = " ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789░▒▓█▀▄▌▐─│┌┐└┘"
+
+
+def synthetic(w, h, font, glyphs, colors, seed=0):
+    # Random canvas, glyphs is the share of non-blank cells, colors the number of distinct colors
+    rng = np.random.default_rng(seed)
+    img = Image(w, h, font)
+    palette = rng.integers(0, 256, (max(1, colors), 3), dtype="u1")
+    img.fg[...] = palette[rng.integers(0, len(palette), (h, w))]
+    img.bg[...] = palette[rng.integers(0, len(palette), (h, w))]
+    codes = np.array([ord(c) for c in GLYPHS[1:]], dtype="u4")
+    img.ch[...] = np.where(rng.random((h, w)) < glyphs, codes[rng.integers(0, len(codes), (h, w))], 32)
+    return img
+
+
+def rss():
+    # Resident memory of the process in bytes. Unlike tracemalloc it sees SDL surfaces too
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is None:
+        return 0
+    # Only the peak so far, in KiB except on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def measure(fn, repeat, img):
+    # Best wall time of repeat runs, then for one more run the peak of the Python and NumPy allocations,
+    # how much the process grew and the size of the tile cache afterwards
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    gc.collect()
+    before = rss()
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, {"peak_bytes": peak, "rss_growth_bytes": max(0, rss() - before), "rss_bytes": rss(),
+                  "tile_cache_bytes": img.tiles.size}
+
+
+def operations(img, font, path, rng):
+    viewport = pygame.Surface(VIEWPORT)
+
+    def redraw():
+        img.redraw()
+        img.blit(viewport, (0, 0), viewport.get_rect())
+
+    def resize():
+        # A zoom level that has not been visited yet, so nothing comes from the tile cache
+        px = img.px
+        img.tiles.clear()
+        img.resize(1.5)
+        img.blit(viewport, (0, 0), viewport.get_rect())
+        img.px = px
+
+    cells = rng.integers(0, [img.w, img.h], (1000, 2)).tolist()
+
+    def set_pixel():
+        for x, y in cells:
+            img.set_pixel(x, y, (255, 255, 255), (0, 0, 0), "#")
+
+    char_map = CharacterMap(320 * .9, font)
+    return {
+        "save": lambda: img.save_to_file(path),
+        "save_minimal": lambda: img.save_to_file(path + ".min", minimal=True),
+        "save_256": lambda: img.save_to_file(path + ".256", palette="256"),
+        "save_16_dither": lambda: img.save_to_file(path + ".16", palette="16", dither=True),
+        "load": lambda: load_image_from_file(path, font),
+        "redraw": redraw,
+        "resize": resize,
+        "set_pixel": set_pixel,
+        "char_map_redraw": char_map.redraw,
+        "char_map_select": lambda: char_map.select(1, 1),
+        "char_map_scroll": lambda: (char_map.scroll(100), char_map.scroll(-100)),
+        "char_map_search": lambda: char_map.search("shade"),
+    }
+
+
+def run(args):
+    pygame.font.init()
+    font = load_font(16)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes.split(","):
+            w, h = map(int, size.lower().split("x"))
+            img = synthetic(w, h, font, args.glyphs, args.colors)
+            path = os.path.join(tmp, f"{size}.ans")
+            img.save_to_file(path)
+            ops = operations(img, font, path, np.random.default_rng(1))
+            # Tiles of the viewport are warm for set_pixel, like in the editor
+            img.blit(pygame.Surface(VIEWPORT), (0, 0), (0, 0, *VIEWPORT))
+            for name in args.ops.split(",") if args.ops else ops:
+                seconds, memory = measure(ops[name], args.repeat, img)
+                results.append({"op": name, "size": size, "seconds": seconds, **memory})
+                print(f"{name:>16} {size:>10} {seconds * 1000:10.2f} ms {memory['peak_bytes'] / 2 ** 20:10.2f} MiB "
+                      f"rss +{memory['rss_growth_bytes'] / 2 ** 20:.2f} MiB "
+                      f"tiles {memory['tile_cache_bytes'] / 2 ** 20:.2f} MiB", file=sys.stderr)
+
+    report = {
+        "meta": {"python": platform.python_version(), "numpy": np.__version__, "pygame": pygame.version.ver,
+                 "machine": platform.machine(), "glyphs": args.glyphs, "colors": args.colors,
+                 "repeat": args.repeat, "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "results": results
+    }
+    if args.out is None:
+        json.dump(report, sys.stdout, indent=2)
+    else:
+        with open(args.out, "w") as ofile:
+            json.dump(report, ofile, indent=2)
+    return 0
+
+
+async def collab_clients(args):
+    w, h = map(int, args.size.lower().split("x"))
+    server = collab.Server(w, h)
+    listener = await server.start("127.0.0.1:0")
+    address = "127.0.0.1:%d" % listener.sockets[0].getsockname()[1]
+    rng = np.random.default_rng(2)
+
+    async def client(n):
+        reader, writer = await collab.open_connection(address)
+        # Hello and the whole canvas
+        await collab.read_message(reader)
+        await collab.read_message(reader)
+        return reader, writer
+
+    clients = [await client(n) for n in range(args.clients)]
+    per_client = args.deltas // args.clients
+
+    async def receive(reader):
+        # Everything the clients send, their own deltas come back to them too
+        for _ in range(per_client * args.clients):
+            await collab.read_message(reader)
+
+    async def send(writer):
+        # Short strokes, each one a delta of a few runs of cells like the editor sends once per frame
+        for _ in range(per_client):
+            start = int(rng.integers(0, w * h - args.cells))
+            index = np.arange(start, start + args.cells)
+            fg = rng.integers(0, 256, (args.cells, 3))
+            writer.write(collab.message(collab.DELTA, collab.encode_delta(index, fg, fg, 65)))
+            await writer.drain()
+
+    start = time.perf_counter()
+    await asyncio.wait_for(asyncio.gather(*(send(wr) for _, wr in clients),
+                                          *(receive(rd) for rd, _ in clients)), 120)
+    seconds = time.perf_counter() - start
+    for _, writer in clients:
+        writer.close()
+    # Let the server see the clients go before the loop shuts down
+    while server.clients:
+        await asyncio.sleep(0.01)
+    listener.close()
+    return server.deltas, per_client * args.clients * args.clients, seconds
+
+
+def collab_throughput(args):
+    # Clients on localhost send deltas to each other through the server, every delta reaches all of them
+    args.deltas -= args.deltas % args.clients
+    applied, received, seconds = asyncio.run(collab_clients(args))
+    print(f"{args.clients} clients, {args.cells} cells per delta: {applied} deltas applied by the server, "
+          f"{received} delivered in {seconds:.2f}s")
+    print(f"{applied / seconds:10.0f} deltas/s applied {received / seconds:10.0f} deltas/s delivered")
+    return 0
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = {(r["op"], r["size"]): r for r in json.load(f)["results"]}
+    with open(args.current) as f:
+        current = json.load(f)["results"]
+
+    regressions = 0
+    for r in current:
+        old = baseline.get((r["op"], r["size"]))
+        if old is None:
+            continue
+        ratio = r["seconds"] / old["seconds"] if old["seconds"] > 0 else 1.0
+        slower = ratio > 1 + args.threshold
+        regressions += slower
+        print(f"{r['op']:>16} {r['size']:>10} {old['seconds'] * 1000:10.2f} ms -> {r['seconds'] * 1000:10.2f} ms "
+              f"({ratio:5.2f}x){'  REGRESSION' if slower else ''}")
+        # Memory as well, with a MiB of slack for the noise of a whole process
+        for key in ("rss_growth_bytes", "tile_cache_bytes"):
+            if key in old and key in r and r[key] > old[key] * (1 + args.threshold) + 2 ** 20:
+                regressions += 1
+                print(f"{'':>16} {'':>10} {key} {old[key] / 2 ** 20:.2f} MiB -> {r[key] / 2 ** 20:.2f} MiB  REGRESSION")
+    if regressions:
+        print(f"{regressions} measurements got more than {args.threshold:.0%} worse")
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for the ansidote hot paths, headless.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("run", help="run the benchmarks and write JSON results")
+    p.add_argument("--sizes", default=",".join(SIZES), help="comma separated WxH canvas sizes")
+    p.add_argument("--ops", default=None, help="comma separated operations, all by default")
+    p.add_argument("--glyphs", type=float, default=0.5, help="share of cells that hold a glyph")
+    p.add_argument("--colors", type=int, default=16, help="number of distinct colors")
+    p.add_argument("--repeat", type=int, default=3, help="runs per operation, the best one counts")
+    p.add_argument("--out", default=None, help="JSON output file, stdout by default")
+    p.set_defaults(func=run)
+
+    p = commands.add_parser("compare", help="fail if current results are slower than a baseline")
+    p.add_argument("baseline")
+    p.add_argument("current")
+    p.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown, 0.2 is 20%%")
+    p.set_defaults(func=compare)
+
+    p = commands.add_parser("collab", help="deltas per second through a local collaboration server")
+    p.add_argument("--clients", type=int, default=4, help="number of headless clients")
+    p.add_argument("--deltas", type=int, default=4000, help="deltas sent in total, spread over the clients")
+    p.add_argument("--cells", type=int, default=64, help="cells per delta")
+    p.add_argument("--size", default="400x200", help="canvas size in cells")
+    p.set_defaults(func=collab_throughput)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())